@@ -0,0 +1,305 @@
+"""
+Banco de pruebas sin conexión para free_games_bot.py
+
+Graba las respuestas reales de Steam y Epic en archivos y luego las
+reproduce desde un servidor local, con latencia y errores configurables,
+para medir un ciclo completo sin depender de las tiendas ni de Telegram.
+
+    python benchmark.py replay --cycles 3           # Reproducir y medir
+    python benchmark.py replay --latency 0.2 --error-rate 0.1
+    python benchmark.py record                      # Regrabar fixtures/ con respuestas reales
+
+fixtures/ trae un conjunto sintético pequeño (REGIONS = ['ES']) para que
+replay funcione sin conexión; record lo sustituye por respuestas reales.
+"""
+import os
+import json
+import time
+import base64
+import random
+import hashlib
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from urllib.parse import urlsplit
+
+import httpx
+
+import free_games_bot as bot_module
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FIXTURES_DIR = os.path.join(SCRIPT_DIR, "fixtures")
+
+# Cabeceras que se guardan con cada respuesta
+RECORDED_HEADERS = ('content-type', 'etag', 'last-modified')
+
+# =============================================================================
+# AUXILIARES
+# =============================================================================
+
+def fixture_key(url):
+    """Nombre de archivo de una petición (hash de la URL completa)"""
+    return hashlib.sha1(str(url).encode('utf-8')).hexdigest()
+
+def use_temporary_data_dir():
+    """Redirige la base de datos y las cachés del bot a una carpeta temporal"""
+    data_dir = tempfile.mkdtemp(prefix="free_games_bench_")
+    bot_module.DATA_DIR = data_dir
+    bot_module.NOTIFIED_DB_FILE = os.path.join(data_dir, "notified_games.db")
+    bot_module.NOTIFIED_GAMES_FILE = os.path.join(data_dir, "notified_games.json")
+    bot_module.STEAM_APP_CACHE_FILE = os.path.join(data_dir, "steam_app_cache.json")
+    bot_module.IMAGE_CACHE_DIR = os.path.join(data_dir, "images")
+    bot_module.TELEGRAM_CHAT_ID = "benchmark"
+    bot_module.SUBSCRIBERS = []
+    bot_module.METRICS_PORT = 0
+    return data_dir
+
+class StubPhoto:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+class StubMessage:
+    def __init__(self, message_id, photo=False):
+        self.message_id = message_id
+        self.photo = [StubPhoto(f"stub-{message_id}")] if photo else None
+
+class StubBot:
+    """Sustituye a telegram.Bot: cuenta los mensajes sin enviarlos"""
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return StubMessage(self.sent)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent += 1
+        return StubMessage(self.sent, photo=True)
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.sent += 1
+        return [StubMessage(self.sent, photo=True) for _ in media]
+
+async def run_bot_cycle(stub_bot):
+    """Ciclo completo: tiendas, cola y envío (con Telegram simulado)"""
+    await bot_module.run_cycle()
+    await bot_module.deliver_pending(stub_bot)
+
+# =============================================================================
+# GRABACIÓN
+# =============================================================================
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Transporte que hace las peticiones reales y guarda cada respuesta"""
+    def __init__(self, fixtures_dir):
+        self.fixtures_dir = fixtures_dir
+        self.transport = httpx.AsyncHTTPTransport()
+        self.recorded = 0
+
+    async def handle_async_request(self, request):
+        response = await self.transport.handle_async_request(request)
+        body = await response.aread()
+
+        fixture = {
+            'url': str(request.url),
+            'status': response.status_code,
+            'headers': {k: v for k, v in response.headers.items() if k.lower() in RECORDED_HEADERS},
+            'body': base64.b64encode(body).decode('ascii')
+        }
+        path = os.path.join(self.fixtures_dir, fixture_key(request.url) + ".json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(fixture, f, ensure_ascii=False, indent=2)
+        self.recorded += 1
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            content=body,
+            request=request
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+async def record(fixtures_dir):
+    """Ejecuta un ciclo real guardando todas las respuestas (sustituye las anteriores)"""
+    os.makedirs(fixtures_dir, exist_ok=True)
+    for name in os.listdir(fixtures_dir):
+        if name.endswith(".json"):
+            os.remove(os.path.join(fixtures_dir, name))
+    use_temporary_data_dir()
+
+    transport = RecordingTransport(fixtures_dir)
+    bot_module.set_http_transport(transport)
+    try:
+        await run_bot_cycle(StubBot())
+    finally:
+        await bot_module.close_http_client()
+
+    print(f"\n💾 {transport.recorded} respuestas guardadas en {fixtures_dir}")
+
+# =============================================================================
+# REPRODUCCIÓN
+# =============================================================================
+
+class StubServer:
+    """
+    Servidor HTTP local que responde con las respuestas grabadas.
+    Las peticiones llegan como /<host>/<ruta>?<query>.
+    """
+    def __init__(self, fixtures_dir, latency=0.0, error_rate=0.0):
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.missing = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def load_fixture(self, url):
+        path = os.path.join(self.fixtures_dir, fixture_key(url) + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    async def handle_connection(self, reader, writer):
+        # Conexiones keep-alive: se atienden peticiones hasta que el cliente cierre
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+
+                target = request_line.decode('latin-1').split()[1]
+                writer.write(await self.build_response("https:/" + target))
+                await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    async def build_response(self, url):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            status, headers, body = 503, {}, b'Service Unavailable'
+        else:
+            fixture = self.load_fixture(url)
+            if fixture is None:
+                self.missing += 1
+                status, headers, body = 404, {}, b'Not Found'
+            else:
+                status, headers = fixture['status'], fixture['headers']
+                body = base64.b64decode(fixture['body'])
+
+        head = f"HTTP/1.1 {status} X\r\nContent-Length: {len(body)}\r\n"
+        head += "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        return (head + "\r\n").encode('latin-1') + body
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Reescribe https://host/ruta a http://127.0.0.1:puerto/host/ruta"""
+    def __init__(self, port):
+        self.port = port
+        self.transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(
+            max_connections=bot_module.MAX_CONCURRENT_REQUESTS,
+            max_keepalive_connections=bot_module.MAX_CONCURRENT_REQUESTS
+        ))
+
+    async def handle_async_request(self, request):
+        parts = urlsplit(str(request.url))
+        target = f"http://127.0.0.1:{self.port}/{parts.netloc}{parts.path}"
+        if parts.query:
+            target += "?" + parts.query
+        request.url = httpx.URL(target)
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+async def replay(fixtures_dir, cycles, latency, error_rate):
+    """Reproduce las respuestas grabadas y mide cada ciclo"""
+    if not os.path.isdir(fixtures_dir) or not os.listdir(fixtures_dir):
+        print(f"❌ No hay respuestas grabadas en {fixtures_dir}. Ejecuta antes: python benchmark.py record")
+        return
+
+    use_temporary_data_dir()
+    server = StubServer(fixtures_dir, latency=latency, error_rate=error_rate)
+    await server.start()
+    bot_module.set_http_transport(ReplayTransport(server.port))
+    stub_bot = StubBot()
+
+    results = []
+    tracemalloc.start()
+    try:
+        for cycle in range(1, cycles + 1):
+            requests_before = server.requests
+            sent_before = stub_bot.sent
+            tracemalloc.reset_peak()
+            started = time.perf_counter()
+
+            await run_bot_cycle(stub_bot)
+
+            results.append({
+                'cycle': cycle,
+                'seconds': time.perf_counter() - started,
+                'requests': server.requests - requests_before,
+                'sent': stub_bot.sent - sent_before,
+                'peak_mb': tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            })
+    finally:
+        tracemalloc.stop()
+        await bot_module.close_http_client()
+        await server.stop()
+
+    print("\n" + "=" * 60)
+    print(f"📊 RESULTADOS (latencia={latency}s, errores={error_rate:.0%})")
+    print("=" * 60)
+    print(f"{'Ciclo':>5} {'Tiempo (s)':>11} {'Peticiones':>11} {'Mensajes':>9} {'Pico (MB)':>10}")
+    for r in results:
+        print(f"{r['cycle']:>5} {r['seconds']:>11.3f} {r['requests']:>11} {r['sent']:>9} {r['peak_mb']:>10.2f}")
+    print(f"\nErrores simulados: {server.errors} | Sin grabación: {server.missing}")
+    print(f"Importación del bot: {bot_module.IMPORT_SECONDS * 1000:.0f} ms")
+    rss = bot_module.peak_rss_mb()
+    if rss is not None:
+        print(f"Memoria residente máxima del proceso: {rss:.1f} MB")
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Banco de pruebas sin conexión del bot de juegos gratis")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help="Graba las respuestas reales de las tiendas")
+    record_parser.add_argument('--fixtures', default=DEFAULT_FIXTURES_DIR, help="Carpeta de grabaciones")
+
+    replay_parser = subparsers.add_parser('replay', help="Reproduce las grabaciones y mide el ciclo")
+    replay_parser.add_argument('--fixtures', default=DEFAULT_FIXTURES_DIR, help="Carpeta de grabaciones")
+    replay_parser.add_argument('--cycles', type=int, default=3, help="Ciclos a ejecutar")
+    replay_parser.add_argument('--latency', type=float, default=0.0, help="Latencia por petición (s)")
+    replay_parser.add_argument('--error-rate', type=float, default=0.0, help="Proporción de respuestas 503")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == 'record':
+        asyncio.run(record(args.fixtures))
+    else:
+        asyncio.run(replay(args.fixtures, args.cycles, args.latency, args.error_rate))
@@ -1,522 +1,2878 @@
 import os
+import sys
 import time
-import requests
+
+# Tiempo de importación del módulo (se muestra al arrancar)
+_import_started = time.perf_counter()
+
+import hashlib
+import httpx
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import json
 import asyncio
 import signal
-import sys
 import re
-from telegram import Bot
-from telegram.error import TelegramError
+import random
+import sqlite3
+import socket
+import html
+import io
+import argparse
+from pathlib import Path
+from collections import deque
+
+# python-telegram-bot y Pillow se importan la primera vez que se usan: un
+# worker que no es el líder, o una ejecución con --once sin nada que enviar,
+# no los carga nunca
+
+# Opcional: orjson procesa los JSON grandes (Epic, appdetails) bastante más rápido
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# =============================================================================
+# CONFIGURACIÓN
+# =============================================================================
+TELEGRAM_BOT_TOKEN = "TU_TOKEN_DE_BOT"  # Obtener de @BotFather
+TELEGRAM_CHAT_ID = "TU_CHAT_ID"  # Tu ID de chat o ID del canal
+
+# Varios chats con un solo bot (opcional). Si está vacío se usa TELEGRAM_CHAT_ID.
+# Cada chat puede filtrar por tienda ('steam', 'epic') y por palabras del título:
+# SUBSCRIBERS = [
+#     {'chat_id': '123456789'},
+#     {'chat_id': '-987654321', 'platforms': ['epic'], 'keywords': ['rpg'], 'exclude_keywords': ['demo']},
+# ]
+SUBSCRIBERS = []
+
+# Carpeta de datos persistentes
+# Si existe /app/data (Docker), usa esa carpeta, sino usa el directorio del script
+if os.path.exists('/app/data'):
+    DATA_DIR = '/app/data'
+else:
+    DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Base de datos de juegos ya notificados (SQLite en modo WAL)
+NOTIFIED_DB_FILE = os.path.join(DATA_DIR, "notified_games.db")
+
+# Formato antiguo: se importa automáticamente a la base de datos
+NOTIFIED_GAMES_FILE = os.path.join(DATA_DIR, "notified_games.json")
+
+# Días que se recuerda un juego notificado antes de permitir avisar de nuevo
+NOTIFIED_RETENTION_DAYS = 7
+
+# Cambios de oferta que se notifican: 'new' (nueva), 'extended' (amplía su
+# fecha de fin) y 'ended' (terminada)
+NOTIFY_CHANGES = ['new', 'extended', 'ended']
+
+# Ciclos seguidos sin ver una oferta sin fecha de fin (Steam) para darla por
+# terminada (evita falsos avisos si una fuente falla en un ciclo)
+OFFER_END_MISSES = 2
+
+# Caché de metadatos de apps de Steam (nombre, F2P, precio)
+STEAM_APP_CACHE_FILE = os.path.join(DATA_DIR, "steam_app_cache.json")
+STEAM_APP_BASIC_TTL = 7 * 24 * 60 * 60  # Nombre y F2P casi nunca cambian
+STEAM_APP_PRICE_TTL = 15 * 60  # El precio cambia con las ofertas
+STEAM_APPDETAILS_BATCH = 50  # App IDs por petición de precios
+
+# Países en los que se comprueban las ofertas (código ISO de 2 letras).
+# Los datos comunes (nombre, F2P) se piden una vez; precios y promociones, por país.
+REGIONS = ['ES']
+EPIC_LOCALE = 'es-ES'  # Idioma de las respuestas de Epic
+STEAM_LANGUAGE = 'spanish'  # Idioma de las respuestas de Steam
+
+# Intervalo de verificación (en segundos)
+CHECK_INTERVAL = 3600  # 1 hora
+
+# Planificación adaptativa: el intervalo se ajusta a las fechas de las promociones
+MIN_CHECK_INTERVAL = 300  # Cerca de un cambio de promoción conocido
+MAX_CHECK_INTERVAL = 4 * 3600  # Tras varios ciclos sin novedades
+ROTATION_WINDOW = 30 * 60  # Margen antes/después de un cambio de promoción
+ROTATION_DELAY = 30  # Segundos tras el inicio para dar tiempo a la tienda
+CHECK_INTERVAL_FLOOR = 60  # Ningún intervalo configurable puede bajar de aquí
+
+# Tiempo máximo (en segundos) que puede tardar cada tienda en un ciclo
+PROVIDER_TIMEOUT = 120
+
+# Límites de envío de Telegram
+TELEGRAM_CHAT_INTERVAL = 1.0  # Segundos entre mensajes a un chat privado
+TELEGRAM_GROUP_INTERVAL = 3.0  # Grupos y canales: ~20 mensajes por minuto
+TELEGRAM_GLOBAL_RATE = 30  # Mensajes por segundo en total
+
+# Reintentos de envío (espera = base * 2^intentos, con tope)
+DELIVERY_MAX_ATTEMPTS = 8
+DELIVERY_BACKOFF_BASE = 5
+DELIVERY_BACKOFF_MAX = 3600
+
+# Si hay varias ofertas pendientes para un chat, se envían en un resumen
+DIGEST_MIN_OFFERS = 3
+DIGEST_MAX_OFFERS = 10  # Ofertas por mensaje (límite de 4096 caracteres y 10 fotos por álbum)
+
+# Notificaciones con portada, precio, fecha de fin y descripción (foto o álbum).
+# Las imágenes se guardan por hash de su contenido y cada una se sube a
+# Telegram una sola vez (después se reutiliza su file_id)
+RICH_NOTIFICATIONS = True
+IMAGE_CACHE_DIR = os.path.join(DATA_DIR, "images")
+IMAGE_CACHE_TTL = 7 * 24 * 60 * 60  # Tras este tiempo se vuelve a descargar la URL
+IMAGE_MAX_SIZE = 1280  # Lado mayor en píxeles (solo con Pillow)
+DESCRIPTION_MAX_LENGTH = 300
+
+# Métricas en formato Prometheus (http://METRICS_HOST:METRICS_PORT/metrics)
+# En Docker usa METRICS_HOST = '0.0.0.0' y publica el puerto. 0 = desactivado
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+
+# Cortacircuitos por endpoint: tras varios fallos seguidos (429/5xx/red) se deja
+# de consultar durante un tiempo que crece exponencialmente (o el Retry-After)
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_BASE_COOLDOWN = 60
+BREAKER_MAX_COOLDOWN = 3600
+
+# Espera tras un error inesperado en el bucle principal (se duplica si se repite)
+ERROR_BACKOFF_BASE = 60
+ERROR_BACKOFF_MAX = 1800
+
+# Cierre limpio: segundos que se dejan para terminar el ciclo y los envíos en
+# curso antes de cancelarlos (en Docker, menos que stop_grace_period)
+SHUTDOWN_TIMEOUT = 20
+
+# Un ciclo interrumpido se retoma al reiniciar (sin volver a consultar las
+# tiendas que ya respondieron) si empezó hace menos de estos segundos
+CHECKPOINT_MAX_AGE = 30 * 60
+
+# Varios workers (réplicas) pueden compartir DATA_DIR en la misma máquina: se
+# reparten las tiendas y solo el líder envía a Telegram y atiende comandos.
+# Si el líder cae, otro toma el relevo en menos de LEASE_TTL segundos.
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = 10  # Segundos sin latido para dar por caído a un worker
+LEASE_RENEW_INTERVAL = 3
+
+# Peticiones HTTP simultáneas como máximo (Steam limita si se abusa)
+MAX_CONCURRENT_REQUESTS = 8
+HTTP_TIMEOUT = 10
+HTTP_KEEPALIVE = 300  # Segundos que se mantiene abierta una conexión inactiva
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
+
+# Configuración externa: variables de entorno con el mismo nombre que las
+# constantes de CONFIG_SETTINGS y, por encima, este archivo JSON, que se
+# vigila y se recarga en caliente (sin reiniciar el bot)
+CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
+CONFIG_POLL_INTERVAL = 5  # Segundos entre comprobaciones del archivo
+
+# Comandos de Telegram (/status, /check_now, /interval, /stats)
+TELEGRAM_COMMANDS = True
+COMMAND_CHAT_IDS = []  # Chats que pueden usarlos. Vacío = los suscriptores
+COMMAND_POLL_TIMEOUT = 30  # Long polling de getUpdates (segundos)
+
+# =============================================================================
+# FUNCIONES AUXILIARES
+# =============================================================================
+
+_notified_db = None
+
+def get_notified_db():
+    """Abre la base de datos de juegos notificados (la crea la primera vez)"""
+    global _notified_db
+    if _notified_db is None:
+        # Con varios workers otro proceso puede tener la base bloqueada un momento
+        conn = sqlite3.connect(NOTIFIED_DB_FILE, timeout=30)
+        # WAL: cada escritura es atómica y un cierre brusco no corrompe la base
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        migrate_notified_chat_column(conn)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS notified_games (
+                chat_id TEXT NOT NULL,
+                platform TEXT NOT NULL,
+                game_id TEXT NOT NULL,
+                notified_at REAL NOT NULL,
+                failed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (chat_id, platform, game_id)
+            )
+        """)
+        migrate_notified_failed_column(conn)
+        conn.execute("CREATE INDEX IF NOT EXISTS notified_games_at ON notified_games (notified_at)")
+        # Cola de mensajes pendientes de enviar a Telegram
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                platform TEXT NOT NULL,
+                game_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                UNIQUE (chat_id, platform, game_id)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt_at)")
+        # Historial de promociones: una fila por oferta y ventana de promoción
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS offer_history (
+                platform TEXT NOT NULL,
+                offer_id TEXT NOT NULL,
+                window_start REAL NOT NULL,
+                window_end REAL,
+                title TEXT NOT NULL,
+                url TEXT NOT NULL,
+                regions TEXT NOT NULL DEFAULT '',
+                first_seen REAL NOT NULL,
+                ended_at REAL,
+                missed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (platform, offer_id, window_start)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS offer_history_window ON offer_history (window_start)")
+        conn.execute("CREATE INDEX IF NOT EXISTS offer_history_open ON offer_history (platform, ended_at)")
+        # Portadas descargadas (archivo por hash del contenido) y su file_id en Telegram
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                url TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_files (
+                content_hash TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL
+            )
+        """)
+        # Estado que sobrevive a un reinicio (punto de control del ciclo, próxima verificación)
+        conn.execute("CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # Workers vivos (último latido) y lease del líder
+        conn.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        _notified_db = conn
+        migrate_notified_json()
+    return _notified_db
+
+def migrate_notified_chat_column(conn):
+    """Las bases anteriores a la multi-suscripción no tenían chat_id: se asigna TELEGRAM_CHAT_ID"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(notified_games)")]
+    if columns and 'chat_id' not in columns:
+        with conn:
+            conn.execute("ALTER TABLE notified_games RENAME TO notified_games_old")
+            conn.execute("DROP INDEX IF EXISTS notified_games_at")
+            conn.execute("""
+                CREATE TABLE notified_games (
+                    chat_id TEXT NOT NULL,
+                    platform TEXT NOT NULL,
+                    game_id TEXT NOT NULL,
+                    notified_at REAL NOT NULL,
+                    PRIMARY KEY (chat_id, platform, game_id)
+                )
+            """)
+            conn.execute(
+                "INSERT INTO notified_games SELECT ?, platform, game_id, notified_at FROM notified_games_old",
+                (str(TELEGRAM_CHAT_ID),)
+            )
+            conn.execute("DROP TABLE notified_games_old")
+
+def migrate_notified_failed_column(conn):
+    """
+    Columna failed: 1 si el mensaje se descartó tras DELIVERY_MAX_ATTEMPTS.
+    Cuenta como avisado para no volver a encolarlo en cada ciclo.
+    """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(notified_games)")]
+    if 'failed' not in columns:
+        with conn:
+            conn.execute("ALTER TABLE notified_games ADD COLUMN failed INTEGER NOT NULL DEFAULT 0")
+
+def migrate_notified_json():
+    """Importa el antiguo notified_games.json y lo renombra a .migrated"""
+    if not os.path.exists(NOTIFIED_GAMES_FILE):
+        return
+    
+    try:
+        with open(NOTIFIED_GAMES_FILE, 'r', encoding='utf-8') as f:
+            games_dict = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️  No se pudo leer {NOTIFIED_GAMES_FILE}, se ignora: {e}")
+        games_dict = {}
+    
+    # El JSON antiguo solo conocía un chat
+    rows = [(str(TELEGRAM_CHAT_ID), platform, str(game_id), notified_at)
+            for platform, games in games_dict.items()
+            for game_id, notified_at in games.items()]
+    with _notified_db:
+        _notified_db.executemany(
+            "INSERT OR IGNORE INTO notified_games (chat_id, platform, game_id, notified_at) VALUES (?, ?, ?, ?)",
+            rows
+        )
+    os.replace(NOTIFIED_GAMES_FILE, NOTIFIED_GAMES_FILE + '.migrated')
+    print(f"📦 {len(rows)} juegos importados de {NOTIFIED_GAMES_FILE}")
+
+def get_state(key, default=None):
+    """Lee un valor guardado en bot_state"""
+    row = get_notified_db().execute("SELECT value FROM bot_state WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def set_state(key, value):
+    """Guarda un valor en bot_state (None lo borra)"""
+    with get_notified_db() as db:
+        if value is None:
+            db.execute("DELETE FROM bot_state WHERE key = ?", (key,))
+        else:
+            db.execute("INSERT OR REPLACE INTO bot_state (key, value) VALUES (?, ?)",
+                       (key, json.dumps(value, ensure_ascii=False)))
+
+def close_notified_db():
+    """Cierra la base de datos (al apagar el bot)"""
+    global _notified_db
+    if _notified_db is not None:
+        _notified_db.close()
+        _notified_db = None
+
+def is_notified(chat_id, platform, game_id):
+    """Indica si un juego ya fue notificado a un chat (o se descartó por fallar siempre)"""
+    row = get_notified_db().execute(
+        "SELECT 1 FROM notified_games WHERE chat_id = ? AND platform = ? AND game_id = ?",
+        (str(chat_id), platform, str(game_id))
+    ).fetchone()
+    return row is not None
+
+def count_notified():
+    """Devuelve {plataforma: número de juegos registrados (en cualquier chat)}"""
+    counts = {key: 0 for key in PROVIDERS}
+    for platform, count in get_notified_db().execute(
+            "SELECT platform, COUNT(DISTINCT game_id) FROM notified_games WHERE NOT failed GROUP BY platform"):
+        counts[platform] = count
+    return counts
+
+def clean_old_games(days=None):
+    """Elimina juegos notificados hace más de X días (NOTIFIED_RETENTION_DAYS por defecto)"""
+    if days is None:
+        days = NOTIFIED_RETENTION_DAYS
+    max_age = days * 24 * 60 * 60  # Convertir días a segundos
+    cutoff = time.time() - max_age
+    
+    # Las promociones que siguen abiertas se conservan: si no, se volverían
+    # a avisar a todos los chats
+    expired = ("notified_at < ? AND NOT EXISTS (SELECT 1 FROM offer_history h WHERE h.platform = "
+               "notified_games.platform AND h.offer_id = notified_games.game_id AND h.ended_at IS NULL)")
+    db = get_notified_db()
+    removed_count = dict(db.execute(
+        f"SELECT platform, COUNT(*) FROM notified_games WHERE {expired} GROUP BY platform",
+        (cutoff,)
+    ).fetchall())
+    
+    total_removed = sum(removed_count.values())
+    if total_removed > 0:
+        with db:
+            db.execute(f"DELETE FROM notified_games WHERE {expired}", (cutoff,))
+        detail = ", ".join(f"{count} de {provider_name(platform)}"
+                           for platform, count in removed_count.items())
+        print(f"🧹 Limpieza: {total_removed} juegos eliminados ({detail}, más de {days} días)")
+
+# =============================================================================
+# HISTORIAL DE OFERTAS
+# =============================================================================
+
+# Promociones abiertas de cada tienda: {plataforma: {offer_id: fila}}.
+# run_cycle la vuelve a leer de la base de datos en cada ciclo, dentro de la
+# transacción (otro worker pudo procesar la tienda entretanto); diff_offers
+# la mantiene al día y solo escribe los cambios.
+_offer_snapshots = {}
+
+def get_offer_snapshot(platform):
+    """Promociones abiertas (sin terminar) de una tienda"""
+    if platform not in _offer_snapshots:
+        _offer_snapshots[platform] = {
+            row[0]: {'window_start': row[1], 'window_end': row[2], 'title': row[3], 'url': row[4],
+                     'regions': row[5], 'missed': row[6]}
+            for row in get_notified_db().execute(
+                "SELECT offer_id, window_start, window_end, title, url, regions, missed "
+                "FROM offer_history WHERE platform = ? AND ended_at IS NULL", (platform,))
+        }
+    return _offer_snapshots[platform]
+
+def history_offer(platform, offer_id, row):
+    """Oferta normalizada a partir de una fila del historial"""
+    offer = {'title': row['title'], 'url': row['url'], 'id': offer_id, 'platform': provider_name(platform),
+             'ends_at': row['window_end']}
+    if row['regions']:
+        offer['regions'] = row['regions'].split(',')
+    return offer
+
+def diff_offers(platform, offers, complete=True):
+    """
+    Compara las ofertas de un ciclo con las promociones abiertas de la tienda,
+    guarda los cambios y devuelve [(cambio, oferta)], con cambio 'new',
+    'extended' o 'ended'. No confirma la transacción: el llamador la confirma
+    junto con los mensajes encolados. Si el resultado no está completo (falló
+    alguna fuente), las ofertas que falten solo terminan por su fecha de fin.
+    
+    La ventana de una promoción empieza en su fecha de inicio (Epic) o cuando
+    se vio por primera vez (Steam), así un ID reutilizado o una oferta que
+    vuelve cuentan como promociones nuevas.
+    """
+    now = time.time()
+    snapshot = get_offer_snapshot(platform)
+    changes = []
+    inserts, updates, ended = [], [], []
+    seen = set()
+    
+    for offer in offers:
+        offer_id = str(offer['id'])
+        seen.add(offer_id)
+        previous = snapshot.get(offer_id)
+        starts_at = offer.get('starts_at')
+        ends_at = offer.get('ends_at')
+        
+        if previous and starts_at in (None, previous['window_start']):
+            if ends_at and previous['window_end'] and ends_at > previous['window_end']:
+                changes.append(('extended', offer))
+            if ends_at != previous['window_end'] or previous['missed']:
+                previous.update(window_end=ends_at or previous['window_end'], missed=0)
+                updates.append((previous['window_end'], platform, offer_id, previous['window_start']))
+            continue
+        
+        if previous:
+            # Mismo ID con otra fecha de inicio: la promoción anterior terminó
+            changes.append(('ended', history_offer(platform, offer_id, previous)))
+            ended.append((now, platform, offer_id, previous['window_start']))
+        
+        row = {'window_start': starts_at or now, 'window_end': ends_at, 'title': offer['title'],
+               'url': offer['url'], 'regions': ",".join(offer.get('regions', [])), 'missed': 0}
+        snapshot[offer_id] = row
+        inserts.append((platform, offer_id, row['window_start'], ends_at, row['title'], row['url'],
+                        row['regions'], now))
+        changes.append(('new', offer))
+    
+    missed = []
+    for offer_id, row in list(snapshot.items()):
+        if offer_id in seen:
+            continue
+        expired = row['window_end'] is not None and row['window_end'] <= now
+        if not complete and not expired:
+            continue
+        row['missed'] += 1
+        if expired or row['window_end'] is None and row['missed'] >= OFFER_END_MISSES:
+            changes.append(('ended', history_offer(platform, offer_id, row)))
+            ended.append((now, platform, offer_id, row['window_start']))
+            del snapshot[offer_id]
+        else:
+            missed.append((platform, offer_id, row['window_start']))
+    
+    db = get_notified_db()
+    db.executemany(
+        "UPDATE offer_history SET ended_at = ? WHERE platform = ? AND offer_id = ? AND window_start = ?",
+        ended
+    )
+    db.executemany(
+        "INSERT OR IGNORE INTO offer_history (platform, offer_id, window_start, window_end, title, url, "
+        "regions, first_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        inserts
+    )
+    db.executemany(
+        "UPDATE offer_history SET window_end = ?, missed = 0 "
+        "WHERE platform = ? AND offer_id = ? AND window_start = ?",
+        updates
+    )
+    db.executemany(
+        "UPDATE offer_history SET missed = missed + 1 WHERE platform = ? AND offer_id = ? AND window_start = ?",
+        missed
+    )
+    return changes
+
+def offers_between(since, until=None, platform=None):
+    """
+    Promociones que estuvieron activas entre dos timestamps (hasta ahora si
+    until es None), de la más reciente a la más antigua
+    """
+    until = time.time() if until is None else until
+    query = ("SELECT platform, offer_id, window_start, window_end, title, url, regions, ended_at "
+             "FROM offer_history WHERE window_start <= ? AND (ended_at IS NULL OR ended_at >= ?)")
+    params = [until, since]
+    if platform is not None:
+        query += " AND platform = ?"
+        params.append(platform)
+    query += " ORDER BY window_start DESC"
+    
+    return [
+        {'platform': row[0], 'id': row[1], 'starts_at': row[2], 'ends_at': row[3], 'title': row[4],
+         'url': row[5], 'regions': row[6].split(',') if row[6] else [], 'ended_at': row[7]}
+        for row in get_notified_db().execute(query, params)
+    ]
+
+# =============================================================================
+# MÉTRICAS
+# =============================================================================
+
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# nombre -> (tipo, descripción)
+METRICS = {
+    'freegames_http_request_duration_seconds': ('histogram', 'Latencia de las peticiones HTTP por endpoint'),
+    'freegames_http_responses_total': ('counter', 'Respuestas HTTP por endpoint y código de estado'),
+    'freegames_parse_duration_seconds': ('histogram', 'Tiempo de procesado de cada respuesta'),
+    'freegames_cache_hits_total': ('counter', 'Aciertos de caché (http: 304 o cuerpo igual, steam_app: appdetails)'),
+    'freegames_cache_misses_total': ('counter', 'Fallos de caché'),
+    'freegames_provider_duration_seconds': ('histogram', 'Duración de cada tienda en un ciclo'),
+    'freegames_provider_errors_total': ('counter', 'Tiendas que fallaron o superaron su tiempo'),
+    'freegames_offers_found_total': ('counter', 'Ofertas gratuitas encontradas por tienda'),
+    'freegames_notifications_total': ('counter', 'Ofertas enviadas o fallidas en Telegram'),
+    'freegames_telegram_send_duration_seconds': ('histogram', 'Latencia de envío a Telegram'),
+    'freegames_circuit_open': ('gauge', 'Cortacircuitos abierto (1) o cerrado (0) por endpoint'),
+    'freegames_cycle_duration_seconds': ('gauge', 'Duración del último ciclo de verificación'),
+    'freegames_last_cycle_timestamp_seconds': ('gauge', 'Momento en que terminó el último ciclo'),
+    'freegames_import_duration_seconds': ('gauge', 'Tiempo de importación del módulo al arrancar'),
+    'freegames_peak_rss_bytes': ('gauge', 'Memoria residente máxima del proceso'),
+}
+
+_metric_values = {}  # (nombre, etiquetas) -> valor, o [buckets..., suma, cuenta]
+
+def metric_key(name, labels):
+    """Clave interna de una serie: nombre y etiquetas ordenadas"""
+    return name, tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+def inc_counter(name, labels=None, value=1):
+    """Incrementa un contador"""
+    key = metric_key(name, labels)
+    _metric_values[key] = _metric_values.get(key, 0) + value
+
+def set_gauge(name, value, labels=None):
+    """Fija el valor de un gauge"""
+    _metric_values[metric_key(name, labels)] = value
+
+def observe(name, value, labels=None):
+    """Registra una medida en un histograma"""
+    key = metric_key(name, labels)
+    histogram = _metric_values.setdefault(key, [0] * len(HISTOGRAM_BUCKETS) + [0.0, 0])
+    for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+        if value <= bucket:
+            histogram[index] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+def format_labels(labels):
+    """Etiquetas en formato {clave="valor",...}"""
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def render_metrics():
+    """Métricas en formato de texto de Prometheus"""
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        series = [(labels, value) for (n, labels), value in sorted(_metric_values.items()) if n == name]
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind != 'histogram':
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            for bucket, count in zip(HISTOGRAM_BUCKETS, value):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bucket),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+def peak_rss_mb():
+    """Memoria residente máxima del proceso (MB), si el sistema lo permite"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KB, macOS en bytes
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def report_footprint(when):
+    """Muestra (y publica como métricas) el tiempo de importación y la memoria máxima"""
+    rss = peak_rss_mb()
+    set_gauge('freegames_import_duration_seconds', IMPORT_SECONDS)
+    line = f"📏 {when}: importación {IMPORT_SECONDS * 1000:.0f} ms"
+    if rss is not None:
+        set_gauge('freegames_peak_rss_bytes', int(rss * 1024 * 1024))
+        line += f", memoria máxima {rss:.1f} MB"
+    print(line)
+
+async def handle_metrics_request(reader, writer):
+    """Atiende una petición HTTP al endpoint de métricas"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render_metrics().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def start_metrics_server():
+    """Arranca el servidor de métricas si METRICS_PORT está configurado"""
+    if not METRICS_PORT:
+        return None
+    try:
+        server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        print(f"⚠️  No se pudo abrir el puerto de métricas {METRICS_PORT}: {e}")
+        return None
+    print(f"📈 Métricas en http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+# =============================================================================
+# REINTENTOS Y CORTACIRCUITOS
+# =============================================================================
+
+class CircuitOpenError(Exception):
+    """El endpoint está en pausa tras demasiados fallos"""
+
+# endpoint -> {'failures': fallos seguidos, 'open_until': timestamp}
+_breakers = {}
+
+def backoff_delay(attempt, base, maximum):
+    """Espera exponencial con jitter (±20%) para el intento N (desde 1)"""
+    delay = min(base * 2 ** max(attempt - 1, 0), maximum)
+    return delay * random.uniform(0.8, 1.2)
+
+def parse_retry_after(value):
+    """Segundos de una cabecera Retry-After (número o fecha HTTP)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def check_breaker(endpoint):
+    """Lanza CircuitOpenError si el endpoint está en pausa"""
+    breaker = _breakers.get(endpoint)
+    if breaker and breaker['open_until'] > time.time():
+        remaining = int(breaker['open_until'] - time.time())
+        raise CircuitOpenError(f"{endpoint} en pausa {remaining}s más tras {breaker['failures']} fallos")
+
+def record_success(endpoint):
+    """Cierra el cortacircuitos de un endpoint"""
+    if endpoint in _breakers:
+        del _breakers[endpoint]
+        set_gauge('freegames_circuit_open', 0, {'endpoint': endpoint})
+
+def record_failure(endpoint, retry_after=None):
+    """Cuenta un fallo y abre el cortacircuitos si toca"""
+    breaker = _breakers.setdefault(endpoint, {'failures': 0, 'open_until': 0})
+    breaker['failures'] += 1
+    
+    if retry_after is not None:
+        cooldown = retry_after
+    elif breaker['failures'] >= BREAKER_FAILURE_THRESHOLD:
+        attempt = breaker['failures'] - BREAKER_FAILURE_THRESHOLD + 1
+        cooldown = backoff_delay(attempt, BREAKER_BASE_COOLDOWN, BREAKER_MAX_COOLDOWN)
+    else:
+        return
+    
+    breaker['open_until'] = time.time() + cooldown
+    set_gauge('freegames_circuit_open', 1, {'endpoint': endpoint})
+    print(f"      🔌 {endpoint}: en pausa {int(cooldown)}s ({breaker['failures']} fallos seguidos)")
+
+# =============================================================================
+# HTTP ASÍNCRONO
+# =============================================================================
+
+_http_client = None
+_http_semaphore = None
+_http_transport = None  # Solo lo cambia benchmark.py (grabar / reproducir)
+
+# Validadores y resultado ya procesado de cada URL consultada con fetch_parsed
+_conditional_cache = {}
+
+def get_http_client():
+    """Devuelve el cliente HTTP compartido (lo crea la primera vez)"""
+    global _http_client, _http_semaphore
+    if _http_client is None:
+        # httpx mantiene un pool de conexiones keep-alive por host
+        _http_client = httpx.AsyncClient(
+            headers=DEFAULT_HEADERS,
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+            transport=_http_transport,
+            limits=httpx.Limits(
+                max_connections=MAX_CONCURRENT_REQUESTS,
+                max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+                keepalive_expiry=HTTP_KEEPALIVE
+            )
+        )
+        _http_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _http_client
+
+def set_http_transport(transport):
+    """Sustituye el transporte HTTP del cliente compartido (para benchmark.py)"""
+    global _http_transport, _http_client
+    _http_transport = transport
+    _http_client = None
+
+def endpoint_label(url):
+    """Host y ruta de una URL, sin parámetros (etiqueta de métricas)"""
+    parsed = httpx.URL(url)
+    return f"{parsed.host}{parsed.path}"
+
+async def fetch(url, params=None, headers=None, endpoint=None):
+    """
+    Hace un GET respetando el límite de peticiones simultáneas y el
+    cortacircuitos del endpoint (lanza CircuitOpenError si está en pausa).
+    endpoint: etiqueta de métricas y cortacircuitos (por defecto, host y ruta)
+    """
+    client = get_http_client()
+    endpoint = endpoint or endpoint_label(url)
+    check_breaker(endpoint)
+    async with _http_semaphore:
+        # Puede haberse abierto mientras esperaba turno
+        check_breaker(endpoint)
+        started = time.perf_counter()
+        try:
+            response = await client.get(url, params=params, headers=headers)
+        except httpx.HTTPError:
+            inc_counter('freegames_http_responses_total', {'endpoint': endpoint, 'status': 'error'})
+            record_failure(endpoint)
+            raise
+        finally:
+            observe('freegames_http_request_duration_seconds', time.perf_counter() - started, {'endpoint': endpoint})
+    inc_counter('freegames_http_responses_total', {'endpoint': endpoint, 'status': response.status_code})
+    
+    if response.status_code == 429 or response.status_code >= 500:
+        record_failure(endpoint, parse_retry_after(response.headers.get('Retry-After')))
+    else:
+        record_success(endpoint)
+    return response
+
+async def fetch_parsed(url, parse, params=None):
+    """
+    GET condicional (ETag / Last-Modified) que devuelve parse(response).
+    Si el servidor responde 304 o el cuerpo no ha cambiado, devuelve
+    el resultado anterior sin volver a procesarlo. Si falla (o el endpoint
+    está en pausa), devuelve el último resultado válido si lo hay.
+    """
+    key = str(httpx.URL(url, params=params))
+    cached = _conditional_cache.get(key)
+    
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    
+    try:
+        response = await fetch(url, params=params, headers=headers)
+        if response.status_code not in (200, 304):
+            raise httpx.HTTPStatusError(f"Error HTTP {response.status_code}",
+                                        request=response.request, response=response)
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        if cached:
+            print(f"      ♻️  {e} → se usa el último resultado válido de {url}")
+            return cached['result']
+        raise
+    
+    if response.status_code == 304 and cached:
+        print(f"      ↺ Sin cambios (304): {url}")
+        inc_counter('freegames_cache_hits_total', {'cache': 'http'})
+        return cached['result']
+    if response.status_code != 200:
+        # 304 sin nada guardado (no debería pasar)
+        raise httpx.HTTPStatusError(f"Error HTTP {response.status_code}",
+                                    request=response.request, response=response)
+    
+    body_hash = hashlib.sha256(response.content).hexdigest()
+    if cached and cached['hash'] == body_hash:
+        print(f"      ↺ Sin cambios (mismo contenido): {url}")
+        inc_counter('freegames_cache_hits_total', {'cache': 'http'})
+        result = cached['result']
+    else:
+        inc_counter('freegames_cache_misses_total', {'cache': 'http'})
+        started = time.perf_counter()
+        result = parse(response)
+        observe('freegames_parse_duration_seconds', time.perf_counter() - started, {'endpoint': endpoint_label(url)})
+    
+    _conditional_cache[key] = {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'hash': body_hash,
+        'result': result
+    }
+    return result
+
+def loads_json(response):
+    """Decodifica el JSON de una respuesta (con orjson si está instalado)"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return json.loads(response.content)
+
+async def close_http_client():
+    """Cierra el cliente HTTP compartido"""
+    global _http_client, _http_semaphore
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        _http_semaphore = None
+
+# =============================================================================
+# PROVEEDORES (TIENDAS)
+# =============================================================================
+
+# Cada tienda registra una función async que devuelve una lista de ofertas
+# normalizadas: {'title', 'url', 'id', 'platform'}. La clave del proveedor
+# es también la plataforma con la que se registran en notified_games.db.
+PROVIDERS = {}
+
+# Últimas ofertas obtenidas de cada proveedor (si falla, se reutilizan)
+_last_good_offers = {}
+
+# Proveedores cuyo último resultado está incompleto (falló alguna fuente o
+# se reutilizó el anterior): sus ofertas ausentes no se dan por terminadas
+_incomplete_providers = set()
+
+class IncompleteResult(Exception):
+    """Una tienda solo pudo consultar parte de sus fuentes; offers es lo obtenido"""
+    def __init__(self, offers, reason):
+        super().__init__(reason)
+        self.offers = offers
+
+def merge_region_results(results):
+    """
+    Como merge_region_offers, pero con el resultado de cada país tal como
+    lo devuelve asyncio.gather(..., return_exceptions=True). Lanza
+    IncompleteResult si algún país falló.
+    """
+    offers = {}
+    failed = []
+    for region, result in results.items():
+        if isinstance(result, IncompleteResult):
+            offers[region] = result.offers
+            failed.append(f"{region}: {result}")
+        elif isinstance(result, Exception):
+            offers[region] = []
+            failed.append(f"{region}: {result}")
+        else:
+            offers[region] = result
+    merged = merge_region_offers(offers)
+    if failed:
+        raise IncompleteResult(merged, "; ".join(failed))
+    return merged
+
+def register_provider(key, name, timeout=PROVIDER_TIMEOUT):
+    """Decorador para registrar una tienda"""
+    def decorator(func):
+        PROVIDERS[key] = {'name': name, 'fetch': func, 'timeout': timeout}
+        return func
+    return decorator
+
+def provider_name(key):
+    """Nombre legible de un proveedor"""
+    return PROVIDERS[key]['name'] if key in PROVIDERS else key
+
+def merge_region_offers(results):
+    """
+    Une las ofertas de varios países ({país: ofertas}) por ID, anotando en
+    'regions' los países en los que está gratis
+    """
+    merged = {}
+    for region, offers in results.items():
+        for offer in offers:
+            if offer['id'] not in merged:
+                merged[offer['id']] = {**offer, 'regions': []}
+            merged[offer['id']]['regions'].append(region)
+    return list(merged.values())
+
+async def run_provider(key):
+    """Ejecuta un proveedor con su propio límite de tiempo"""
+    provider = PROVIDERS[key]
+    print(f"🔍 Verificando {provider['name']}...")
+    started = time.perf_counter()
+    _incomplete_providers.add(key)
+    try:
+        offers = await asyncio.wait_for(provider['fetch'](), timeout=provider['timeout'])
+        inc_counter('freegames_offers_found_total', {'provider': key}, len(offers))
+        _last_good_offers[key] = offers
+        _incomplete_providers.discard(key)
+        return offers
+    except IncompleteResult as e:
+        # Lo obtenido sirve para avisar de ofertas nuevas, pero no para dar otras por terminadas
+        print(f"   ⚠️  {provider['name']}: resultado incompleto ({e})")
+        inc_counter('freegames_provider_errors_total', {'provider': key, 'reason': 'incomplete'})
+        inc_counter('freegames_offers_found_total', {'provider': key}, len(e.offers))
+        return e.offers
+    except asyncio.TimeoutError:
+        print(f"   ⏱️  {provider['name']}: sin respuesta en {provider['timeout']}s, se usa el último resultado")
+        inc_counter('freegames_provider_errors_total', {'provider': key, 'reason': 'timeout'})
+    except Exception as e:
+        print(f"   ❌ Error al verificar {provider['name']}: {e}")
+        inc_counter('freegames_provider_errors_total', {'provider': key, 'reason': 'error'})
+    finally:
+        observe('freegames_provider_duration_seconds', time.perf_counter() - started, {'provider': key})
+    return _last_good_offers.get(key, [])
+
+# =============================================================================
+# STEAM
+# =============================================================================
+
+STEAM_FEATURED_URL = "https://store.steampowered.com/api/featured/"
+STEAM_SEARCH_URL = "https://store.steampowered.com/search/results/"
+STEAM_FEATURED_CATEGORIES_URL = "https://store.steampowered.com/api/featuredcategories/"
+
+STEAM_HEADER_IMAGE_URL = "https://cdn.akamai.steamstatic.com/steam/apps/{app_id}/header.jpg"
+STEAM_SEARCH_PAGE_SIZE = 100  # Máximo que admite la búsqueda
+STEAM_SEARCH_MAX_PAGES = 20  # Tope de seguridad
+
+# Cada fila de la búsqueda es un <a ... data-ds-appid="..."> con el título
+# y un bloque de descuento con data-discount / data-price-final
+STEAM_SEARCH_ROW_RE = re.compile(r'<a\b[^>]*\bdata-ds-appid="(\d+)"')
+STEAM_SEARCH_TITLE_RE = re.compile(r'<span class="title">(.*?)</span>', re.S)
+STEAM_SEARCH_DISCOUNT_RE = re.compile(r'\bdata-discount="(\d+)"')
+STEAM_SEARCH_PRICE_RE = re.compile(r'\bdata-price-final="(\d+)"')
+
+def steam_game(app_id, title, details=None):
+    """
+    Construye el diccionario (oferta normalizada) de un juego de Steam,
+    con portada, descripción y precio si se conocen sus detalles
+    """
+    details = details or {}
+    game = {
+        'title': title,
+        'url': f"https://store.steampowered.com/app/{app_id}",
+        'id': str(app_id),
+        'platform': 'Steam',
+        'image': details.get('header_image') or STEAM_HEADER_IMAGE_URL.format(app_id=app_id)
+    }
+    if details.get('short_description'):
+        game['description'] = html.unescape(re.sub(r'<[^>]+>', '', details['short_description'])).strip()
+    if details.get('original_price'):
+        game['original_price'] = details['original_price']
+        game['currency'] = details.get('currency')
+    return game
+
+def parse_steam_featured(data):
+    """Extrae (app_id, nombre) de los juegos con 100% de descuento en Featured"""
+    candidates = []
+    for category in ['large_capsules', 'featured_win', 'featured_mac', 'featured_linux']:
+        if category in data:
+            print(f"      - Categoría {category}: {len(data[category])} juegos")
+            for game in data[category]:
+                discount = game.get('discount_percent', 0)
+                if discount > 0:
+                    print(f"        · {game.get('name')}: {discount}% descuento")
+                
+                if discount == 100 and game.get('id'):
+                    candidates.append((str(game['id']), game.get('name', 'Desconocido')))
+    return candidates
+
+def parse_steam_featured_categories(data):
+    """Extrae (app_id, nombre) de los juegos con 100% de descuento en Featured Categories"""
+    candidates = []
+    categories = ['specials', 'coming_soon', 'top_sellers', 'new_releases']
+    for category in categories:
+        if category in data:
+            items = data[category].get('items', []) if isinstance(data[category], dict) else data[category]
+            if items:
+                print(f"      - Categoría {category}: {len(items)} juegos")
+                for game in items:
+                    if game.get('discount_percent', 0) == 100 and game.get('id'):
+                        candidates.append((str(game['id']), game.get('name', 'Desconocido')))
+    return candidates
+
+def parse_steam_search_rows(results_html):
+    """
+    Recorre las filas del HTML de resultados sin construir un DOM.
+    Devuelve [{'app_id', 'title', 'discount', 'final_price'}]; discount y
+    final_price son None si la fila no trae bloque de descuento.
+    """
+    rows = []
+    matches = list(STEAM_SEARCH_ROW_RE.finditer(results_html))
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(results_html)
+        row_html = results_html[match.start():end]
+        
+        title = STEAM_SEARCH_TITLE_RE.search(row_html)
+        discount = STEAM_SEARCH_DISCOUNT_RE.search(row_html)
+        final_price = STEAM_SEARCH_PRICE_RE.search(row_html)
+        rows.append({
+            'app_id': match.group(1),
+            'title': html.unescape(title.group(1).strip()) if title else 'Desconocido',
+            'discount': int(discount.group(1)) if discount else None,
+            'final_price': int(final_price.group(1)) if final_price else None
+        })
+    return rows
+
+def parse_steam_search_page(response):
+    """Procesa una página JSON (infinite=1) de la búsqueda de especiales"""
+    data = loads_json(response)
+    return {
+        'total': int(data.get('total_count') or 0),
+        'rows': parse_steam_search_rows(data.get('results_html') or '')
+    }
+
+async def fetch_steam_search(cc):
+    """
+    Descarga todas las páginas de la búsqueda de juegos gratis en oferta
+    de un país. La primera indica el total; el resto se piden en paralelo.
+    """
+    params = {
+        'cc': cc,
+        'l': STEAM_LANGUAGE,
+        'query': '',
+        'count': STEAM_SEARCH_PAGE_SIZE,
+        'maxprice': 'free',
+        'specials': 1,
+        'ndl': 1,
+        'infinite': 1
+    }
+    first = await fetch_parsed(STEAM_SEARCH_URL, parse_steam_search_page, params={**params, 'start': 0})
+    
+    total = min(first['total'], STEAM_SEARCH_PAGE_SIZE * STEAM_SEARCH_MAX_PAGES)
+    starts = range(STEAM_SEARCH_PAGE_SIZE, total, STEAM_SEARCH_PAGE_SIZE)
+    pages = await asyncio.gather(
+        *(fetch_parsed(STEAM_SEARCH_URL, parse_steam_search_page, params={**params, 'start': start})
+          for start in starts),
+        return_exceptions=True
+    )
+    
+    rows = list(first['rows'])
+    for start, page in zip(starts, pages):
+        if source_ok(f"Búsqueda [{cc}] (desde {start})", page):
+            rows.extend(page['rows'])
+    
+    print(f"      - Búsqueda [{cc}]: {len(rows)} resultados de {first['total']} ({len(starts) + 1} páginas)")
+    return rows
+
+def source_ok(name, result):
+    """Comprueba si una fuente se pudo consultar y muestra el error si no"""
+    if isinstance(result, Exception):
+        print(f"      ❌ {name}: {result}")
+        return False
+    return True
+
+@register_provider('steam', 'Steam')
+async def check_steam_via_steamdb():
+    """
+    Busca juegos con 100% de descuento en Steam en todos los países de
+    REGIONS a la vez
+    """
+    results = await asyncio.gather(*(check_steam_region(region.lower()) for region in REGIONS),
+                                   return_exceptions=True)
+    try:
+        free_games = merge_region_results(dict(zip(REGIONS, results)))
+    except IncompleteResult as e:
+        print(f"   📊 Total juegos gratis encontrados en Steam: {len(e.offers)} (resultado incompleto)")
+        raise
+    print(f"   📊 Total juegos gratis encontrados en Steam: {len(free_games)}")
+    return free_games
+
+async def check_steam_region(cc):
+    """
+    Busca juegos con 100% de descuento en Steam para un país usando
+    múltiples métodos. Las tres fuentes y las consultas por juego se lanzan
+    en paralelo. Si falla alguna, lanza IncompleteResult con lo encontrado.
+    """
+    free_games = []
+    found_ids = set()
+    failed = []
+    
+    try:
+        print(f"   🔍 [{cc}] Consultando Featured API, búsqueda de especiales y Featured Categories")
+        region_params = {'cc': cc, 'l': STEAM_LANGUAGE}
+        featured, search_rows, categories = await asyncio.gather(
+            fetch_parsed(STEAM_FEATURED_URL, lambda r: parse_steam_featured(loads_json(r)), params=region_params),
+            fetch_steam_search(cc),
+            fetch_parsed(STEAM_FEATURED_CATEGORIES_URL, lambda r: parse_steam_featured_categories(loads_json(r)),
+                         params=region_params),
+            return_exceptions=True
+        )
+        
+        # Método 1 y 3: juegos con 100% de descuento (hay que descartar los F2P)
+        discounted = {}
+        if source_ok("Featured API", featured):
+            for app_id, name in featured:
+                discounted.setdefault(app_id, name)
+        else:
+            failed.append("Featured API")
+        if source_ok("Featured Categories", categories):
+            for app_id, name in categories:
+                discounted.setdefault(app_id, name)
+        else:
+            failed.append("Featured Categories")
+        
+        # Método 2: búsqueda de especiales. Una fila con -100% es un juego de pago
+        # regalado (un F2P no tiene descuento), así que no necesita appdetails.
+        # Solo las filas sin bloque de descuento se consultan aparte.
+        search_free = {}
+        search_ids = []
+        if source_ok("Búsqueda de especiales", search_rows):
+            for row in search_rows:
+                if row['discount'] == 100 and row['final_price'] in (0, None):
+                    search_free.setdefault(row['app_id'], row['title'])
+                elif row['discount'] is None and row['app_id'] not in search_ids:
+                    search_ids.append(row['app_id'])
+        else:
+            failed.append("Búsqueda de especiales")
+        
+        for app_id in search_free:
+            discounted.pop(app_id, None)
+        search_ids = [a for a in search_ids if a not in discounted and a not in search_free]
+        
+        # Consultas por juego agrupadas en una sola pasada por la caché. De los
+        # juegos de la búsqueda solo hacen falta portada y descripción (sin precio).
+        apps, search_details = await asyncio.gather(
+            get_steam_apps(list(discounted) + search_ids, cc),
+            get_steam_apps(list(search_free), cc, prices=False)
+        )
+        
+        for app_id, name in search_free.items():
+            print(f"        ✓ {name}: -100% en la búsqueda")
+            found_ids.add(app_id)
+            free_games.append(steam_game(app_id, name, search_details.get(app_id)))
+        
+        for app_id, name in discounted.items():
+            is_f2p = (apps.get(app_id) or {}).get('is_free', False)
+            print(f"        ✓ {name}: 100% descuento! F2P: {is_f2p}")
+            if not is_f2p and app_id not in found_ids:
+                found_ids.add(app_id)
+                free_games.append(steam_game(app_id, name, apps.get(app_id)))
+        
+        for app_id in search_ids:
+            details = apps.get(app_id)
+            if not details:
+                print(f"        · ID {app_id}: Sin detalles")
+                # Sin entrada en caché es que appdetails falló (no que no exista)
+                if app_id not in load_steam_app_cache():
+                    failed.append(f"appdetails {app_id}")
+                continue
+            
+            name = details.get('name', 'Desconocido')
+            original_price = details.get('original_price', 0)
+            final_price = details.get('final_price', 0)
+            is_f2p = details.get('is_free', False)
+            
+            print(f"        · {name}: Final={final_price}, Original={original_price}, F2P={is_f2p}")
+            
+            # Si aparece en búsqueda "maxprice=free" con precio original > 0
+            # O si final_price = 0 y original_price > 0
+            # Entonces es una promoción temporal gratuita
+            if original_price > 0 and app_id not in found_ids:
+                # Tiene precio original, así que no es F2P permanente
+                found_ids.add(app_id)
+                free_games.append(steam_game(app_id, name, details))
+                print(f"          ✅ GRATIS TEMPORAL (aparece en búsqueda de gratis)!")
+    
+    except Exception as e:
+        print(f"   ❌ Error al verificar Steam [{cc}]: {e}")
+        import traceback
+        traceback.print_exc()
+        raise IncompleteResult(free_games, str(e)) from e
+    
+    if failed:
+        raise IncompleteResult(free_games, f"fallaron: {', '.join(failed)}")
+    return free_games
+
+# =============================================================================
+# CACHÉ DE APPS DE STEAM
+# =============================================================================
+
+STEAM_APPDETAILS_URL = "https://store.steampowered.com/api/appdetails"
+
+_steam_app_cache = None
+_steam_app_inflight = {}
+
+def load_steam_app_cache():
+    """Carga la caché de apps de Steam desde archivo (solo la primera vez)"""
+    global _steam_app_cache
+    if _steam_app_cache is None:
+        _steam_app_cache = {}
+        if os.path.exists(STEAM_APP_CACHE_FILE):
+            try:
+                with open(STEAM_APP_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    _steam_app_cache = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️  Caché de Steam ilegible, se empieza de cero: {e}")
+    return _steam_app_cache
+
+def save_steam_app_cache():
+    """Guarda la caché de apps eliminando las entradas caducadas"""
+    cache = load_steam_app_cache()
+    now = time.time()
+    for app_id in [a for a, e in cache.items() if now - e.get('basic_at', 0) > STEAM_APP_BASIC_TTL]:
+        del cache[app_id]
+    
+    tmp_file = STEAM_APP_CACHE_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False)
+    os.replace(tmp_file, STEAM_APP_CACHE_FILE)
+
+def appdetails_entries(response):
+    """Devuelve {app_id: data} de una respuesta de appdetails (None si no existe)"""
+    entries = {}
+    if response.status_code == 200:
+        for app_id, entry in (loads_json(response) or {}).items():
+            if entry and entry.get('success'):
+                # Steam devuelve una lista vacía si el filtro no tiene datos
+                data = entry.get('data')
+                entries[app_id] = data if isinstance(data, dict) else {}
+            else:
+                entries[app_id] = None
+    return entries
+
+async def request_steam_basic(app_id):
+    """
+    Pide nombre, F2P, portada y descripción de una app (Steam no admite
+    varias apps con este filtro)
+    """
+    params = {'appids': app_id, 'filters': 'basic', 'l': STEAM_LANGUAGE}
+    return appdetails_entries(await fetch(STEAM_APPDETAILS_URL, params=params))
+
+async def request_steam_prices(app_ids, cc):
+    """Pide el precio en un país de varias apps en una sola petición"""
+    params = {'appids': ','.join(app_ids), 'filters': 'price_overview', 'cc': cc, 'l': STEAM_LANGUAGE}
+    return appdetails_entries(await fetch(STEAM_APPDETAILS_URL, params=params))
+
+async def fetch_steam_field(kind, app_ids, cc=None):
+    """
+    Descarga un tipo de dato ('basic', común a todos los países, o 'price'
+    del país cc) para varias apps.
+    Si otra tarea ya está pidiendo la misma app, espera a esa petición.
+    """
+    loop = asyncio.get_running_loop()
+    futures = {}
+    pending = []
+    for app_id in app_ids:
+        key = (kind, cc, app_id)
+        if key not in _steam_app_inflight:
+            _steam_app_inflight[key] = loop.create_future()
+            pending.append(app_id)
+        futures[app_id] = _steam_app_inflight[key]
+    
+    if pending:
+        if kind == 'price':
+            calls = [request_steam_prices(pending[i:i + STEAM_APPDETAILS_BATCH], cc)
+                        for i in range(0, len(pending), STEAM_APPDETAILS_BATCH)]
+        else:
+            calls = [request_steam_basic(app_id) for app_id in pending]
+        
+        merged = {}
+        try:
+            results = await asyncio.gather(*calls, return_exceptions=True)
+            errors = [result for result in results if isinstance(result, Exception)]
+            for result in results:
+                if not isinstance(result, Exception):
+                    merged.update(result)
+            if errors:
+                print(f"      ❌ appdetails ({kind}): {len(errors)} de {len(calls)} peticiones fallaron ({errors[0]})")
+        finally:
+            # Las apps que fallaron quedan sin resolver (False) y no se guardan.
+            # También si se cancela la tarea, para no dejar a otras esperando.
+            for app_id in pending:
+                future = _steam_app_inflight.pop((kind, cc, app_id))
+                if not future.done():
+                    future.set_result(merged.get(app_id, False))
+    
+    # shield: si se cancela una tarea que solo espera, no se cancela el futuro
+    # compartido (ni la tarea que lo está resolviendo)
+    results = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+    return dict(zip(futures, results))
+
+async def get_steam_apps(app_ids, cc, prices=True):
+    """
+    Obtiene los detalles de varias apps de Steam usando la caché, con el
+    precio del país cc (si prices es False, solo el que ya esté en caché).
+    Devuelve {app_id: detalles o None}.
+    """
+    cache = load_steam_app_cache()
+    now = time.time()
+    app_ids = list(dict.fromkeys(str(a) for a in app_ids))
+    
+    # Las entradas de versiones anteriores no tienen portada: se piden otra vez
+    need_basic = [a for a in app_ids if now - cache.get(a, {}).get('basic_at', 0) > STEAM_APP_BASIC_TTL
+                  or cache[a].get('found') and 'header_image' not in cache[a]]
+    need_price = [a for a in app_ids
+                  if prices and now - cache.get(a, {}).get('prices_at', {}).get(cc, 0) > STEAM_APP_PRICE_TTL]
+    
+    misses = len(set(need_basic) | set(need_price))
+    inc_counter('freegames_cache_hits_total', {'cache': 'steam_app'}, len(app_ids) - misses)
+    inc_counter('freegames_cache_misses_total', {'cache': 'steam_app'}, misses)
+    
+    if need_basic or need_price:
+        print(f"      - appdetails [{cc}]: {len(app_ids) - len(need_basic)} en caché, "
+              f"{len(need_basic)} sin datos básicos, {len(need_price)} sin precio")
+        basic, prices = await asyncio.gather(
+            fetch_steam_field('basic', need_basic),
+            fetch_steam_field('price', need_price, cc)
+        )
+        
+        for app_id, data in basic.items():
+            if data is not False:
+                entry = cache.setdefault(app_id, {})
+                entry['found'] = data is not None
+                entry['name'] = (data or {}).get('name', 'Desconocido')
+                entry['is_free'] = (data or {}).get('is_free', False)
+                entry['header_image'] = (data or {}).get('header_image')
+                entry['short_description'] = (data or {}).get('short_description')
+                entry['basic_at'] = now
+        for app_id, data in prices.items():
+            if data is not False and app_id in cache:
+                cache[app_id].setdefault('prices', {})[cc] = (data or {}).get('price_overview', {})
+                cache[app_id].setdefault('prices_at', {})[cc] = now
+        
+        save_steam_app_cache()
+    
+    apps = {}
+    for app_id in app_ids:
+        entry = cache.get(app_id)
+        if not entry or not entry.get('found'):
+            apps[app_id] = None
+            continue
+        
+        price_overview = entry.get('prices', {}).get(cc) or {}
+        apps[app_id] = {
+            'name': entry.get('name', 'Desconocido'),
+            'is_free': entry.get('is_free', False),
+            'final_price': price_overview.get('final', 0),
+            'original_price': price_overview.get('initial', 0),
+            'discount_percent': price_overview.get('discount_percent', 0),
+            'currency': price_overview.get('currency'),
+            'header_image': entry.get('header_image'),
+            'short_description': entry.get('short_description')
+        }
+    return apps
+
+# =============================================================================
+# EPIC GAMES
+# =============================================================================
+
+EPIC_PROMOTIONS_URL = "https://store-site-backend-static.ak.epicgames.com/freeGamesPromotions"
+
+def parse_epic_date(value):
+    """Convierte una fecha de Epic ('2024-01-01T16:00:00.000Z') a timestamp"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+def epic_promotion_dates(promotions):
+    """Fechas de fin de las promociones activas e inicio de las gratuitas próximas"""
+    dates = []
+    for block in promotions.get('promotionalOffers') or []:
+        for offer in block.get('promotionalOffers', []):
+            dates.append(parse_epic_date(offer.get('endDate')))
+    for block in promotions.get('upcomingPromotionalOffers') or []:
+        for offer in block.get('promotionalOffers', []):
+            # Solo interesan las que dejarán el juego gratis
+            discount = offer.get('discountSetting', {}).get('discountPercentage', 0)
+            if discount == 0:
+                dates.append(parse_epic_date(offer.get('startDate')))
+    return [date for date in dates if date]
+
+# Imágenes de Epic por orden de preferencia para la notificación
+EPIC_IMAGE_TYPES = ('OfferImageWide', 'DieselStoreFrontWide', 'featuredMedia', 'Thumbnail', 'OfferImageTall')
+
+def epic_image(key_images):
+    """URL de la mejor portada de keyImages (None si no hay)"""
+    by_type = {image.get('type'): image.get('url') for image in key_images or [] if image.get('url')}
+    for image_type in EPIC_IMAGE_TYPES:
+        if by_type.get(image_type):
+            return by_type[image_type]
+    return next(iter(by_type.values()), None)
+
+def parse_epic_promotions(response, country):
+    """
+    Extrae los juegos gratis temporalmente de la respuesta de Epic para un
+    país y las fechas de cambio de promoción: {'games': [...], 'events': [...]}
+    Solo se miran id, title, description, keyImages, price.totalPrice y
+    promotions de cada elemento.
+    """
+    free_games = []
+    events = set()
+    data = loads_json(response)
+    
+    try:
+        games = data['data']['Catalog']['searchStore']['elements']
+    except (KeyError, TypeError):
+        print(f"   ⚠️  Epic [{country}]: respuesta sin catálogo")
+        return {'games': [], 'events': []}
+    
+    promoted = 0
+    for game in games:
+        promotions = game.get('promotions')
+        if not promotions:
+            continue
+        events.update(epic_promotion_dates(promotions))
+        
+        # Verificar si está en promoción actualmente
+        active = promotions.get('promotionalOffers')
+        offers = active[0].get('promotionalOffers') if active else None
+        if not offers:
+            continue
+        promoted += 1
+        
+        # Gratis temporalmente (precio original > 0, actual = 0)
+        total_price = (game.get('price') or {}).get('totalPrice') or {}
+        original_price = total_price.get('originalPrice', 0)
+        if original_price > 0 and total_price.get('discountPrice', 0) == 0:
+            title = game.get('title', 'Desconocido')
+            free_games.append({
+                'title': title,
+                'url': f"https://store.epicgames.com/{EPIC_LOCALE}/free-games",
+                'id': game.get('id'),
+                'platform': 'Epic Games',
+                'original_price': original_price,
+                'currency': total_price.get('currencyCode'),
+                'image': epic_image(game.get('keyImages')),
+                'description': game.get('description') or '',
+                'starts_at': parse_epic_date(offers[0].get('startDate')),
+                'ends_at': parse_epic_date(offers[0].get('endDate'))
+            })
+            print(f"   ✅ [{country}] Juego gratis detectado: {title}")
+    
+    print(f"   📊 Epic [{country}]: {len(games)} juegos, {promoted} en promoción, {len(free_games)} gratis")
+    return {'games': free_games, 'events': sorted(events)}
+
+@register_provider('epic', 'Epic Games')
+async def check_epic_free_games():
+    """
+    Busca juegos gratuitos en Epic Games Store en todos los países de
+    REGIONS a la vez
+    """
+    results = await asyncio.gather(*(check_epic_region(country) for country in REGIONS),
+                                   return_exceptions=True)
+    return merge_region_results(dict(zip(REGIONS, results)))
+
+async def check_epic_region(country):
+    """
+    Busca juegos gratuitos en Epic Games Store para un país (lanza
+    IncompleteResult si no se pudo consultar)
+    """
+    free_games = []
+    
+    try:
+        params = {
+            'locale': EPIC_LOCALE,
+            'country': country,
+            'allowCountries': country
+        }
+        
+        result = await fetch_parsed(EPIC_PROMOTIONS_URL, lambda r: parse_epic_promotions(r, country), params=params)
+        add_schedule_events(result['events'])
+        free_games = list(result['games'])
+    
+    except Exception as e:
+        print(f"   ❌ Error al verificar Epic Games [{country}]: {e}")
+        import traceback
+        traceback.print_exc()
+        raise IncompleteResult(free_games, str(e)) from e
+    
+    return free_games
+
+# =============================================================================
+# TELEGRAM
+# =============================================================================
+
+_bot = None
+
+def get_bot():
+    """Devuelve el bot de Telegram (importa python-telegram-bot la primera vez)"""
+    global _bot
+    if _bot is None:
+        from telegram import Bot
+        _bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    return _bot
+
+async def test_telegram_connection(chat_ids):
+    """
+    Prueba la conexión con Telegram y envía un mensaje de prueba a cada
+    chat de chat_ids. Devuelve el nombre del bot, o None si falla.
+    """
+    from telegram.error import TelegramError
+    
+    try:
+        print("\n🔧 Probando conexión con Telegram...")
+        bot = get_bot()
+        
+        # Obtener info del bot
+        bot_info = await bot.get_me()
+        print(f"✓ Bot conectado: @{bot_info.username}")
+        
+        # Intentar enviar mensaje de prueba a cada chat
+        test_message = "🤖 Bot de juegos gratis iniciado correctamente.\n\n✅ Las notificaciones llegarán aquí."
+        
+        for chat_id in chat_ids:
+            result = await bot.send_message(
+                chat_id=chat_id,
+                text=test_message,
+                parse_mode='HTML'
+            )
+            
+            print(f"✓ Mensaje de prueba enviado correctamente (ID: {result.message_id})")
+            print(f"✓ Chat ID verificado: {chat_id}")
+        return bot_info.username
+        
+    except TelegramError as e:
+        print(f"❌ Error de Telegram: {e}")
+        
+        if "Unauthorized" in str(e):
+            print("   → El token del bot es inválido. Verifica con @BotFather")
+        elif "chat not found" in str(e) or "Bad Request" in str(e):
+            print("   → El Chat ID es incorrecto o el bot no puede enviarte mensajes")
+            print("   → SOLUCIÓN: Envía un mensaje a tu bot primero (cualquier mensaje)")
+            print("   → O usa @userinfobot para verificar tu Chat ID")
+        
+        return None
+    except Exception as e:
+        print(f"❌ Error inesperado: {e}")
+        return None
+
+async def verify_telegram(force=False):
+    """
+    Verifica el token y los chats solo si han cambiado desde la última
+    verificación correcta (guardada en bot_state), o siempre con force.
+    Así un reinicio no llama a Telegram ni repite el mensaje de prueba.
+    """
+    token_hash = hashlib.sha256(TELEGRAM_BOT_TOKEN.encode('utf-8')).hexdigest()
+    chat_ids = [str(subscriber['chat_id']) for subscriber in get_subscribers()]
+    verified = get_state('telegram_verified')
+    if force or not verified or verified['token_hash'] != token_hash:
+        verified = {'token_hash': token_hash, 'chats': []}
+    
+    pending = [chat_id for chat_id in chat_ids if chat_id not in verified['chats']]
+    if not pending:
+        print(f"✓ Bot @{verified['username']} ya verificado (--verify para repetir la prueba)")
+        return True
+    
+    username = await test_telegram_connection(pending)
+    if username is None:
+        return False
+    set_state('telegram_verified', {'token_hash': token_hash, 'username': username,
+                                    'chats': sorted(set(verified['chats']) | set(pending))})
+    return True
+
+# Límites de longitud de Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_CAPTION_LIMIT = 1024
+
+def format_regions(game_info):
+    """Países en los que está gratis ('' si no se indica)"""
+    return ", ".join(game_info.get('regions', []))
+
+def format_change(game_info):
+    """Texto breve del cambio de una oferta ('' si es nueva)"""
+    change = game_info.get('change', 'new')
+    if change == 'extended':
+        ends_at = datetime.fromtimestamp(game_info['ends_at']).strftime('%Y-%m-%d %H:%M')
+        return f"⏳ ampliada hasta {ends_at}"
+    if change == 'ended':
+        return "⌛ terminada"
+    return ""
+
+def format_price(cents, currency):
+    """Precio legible a partir de céntimos ('19,99 EUR')"""
+    amount = f"{cents / 100:.2f}".replace('.', ',')
+    return f"{amount} {currency}" if currency else amount
+
+def shorten(text, length):
+    """Recorta un texto a la última palabra completa que quepa"""
+    text = " ".join(text.split())
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(' ', 1)[0] + "…"
+
+def format_game_message(game_info, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Mensaje de Telegram para un juego. Con precio, fecha de fin y descripción
+    si se conocen; la descripción se recorta para no pasar de limit (4096 en
+    un mensaje, 1024 en el pie de una foto).
+    """
+    change = format_change(game_info)
+    if change:
+        return (
+            f"🎮 <b>Oferta {change}</b>\n\n"
+            f"<b>Título:</b> {html.escape(game_info['title'])}\n"
+            f"<b>Plataforma:</b> {game_info['platform']}\n"
+            f"<b>Enlace:</b> {game_info['url']}"
+        )
+    regions = format_regions(game_info)
+    details = ""
+    if regions:
+        details += f"<b>Regiones:</b> {regions}\n"
+    if game_info.get('original_price'):
+        details += f"<b>Precio habitual:</b> <s>{format_price(game_info['original_price'], game_info.get('currency'))}</s>\n"
+    if game_info.get('ends_at'):
+        details += f"<b>Gratis hasta:</b> {datetime.fromtimestamp(game_info['ends_at']).strftime('%Y-%m-%d %H:%M')}\n"
+    
+    header = (
+        f"🎮 <b>¡JUEGO GRATIS!</b> 🎮\n\n"
+        f"<b>Título:</b> {html.escape(game_info['title'])}\n"
+        f"<b>Plataforma:</b> {game_info['platform']}\n"
+        f"{details}"
+        f"<b>Enlace:</b> {game_info['url']}\n\n"
+    )
+    footer = "⏰ <i>¡Aprovecha antes de que termine la oferta!</i>"
+    
+    # La descripción ocupa lo que quede hasta el límite (escapar puede alargarla)
+    description = ""
+    room = limit - len(header) - len(footer) - len("<i></i>\n\n")
+    length = min(DESCRIPTION_MAX_LENGTH, room)
+    while game_info.get('description') and length > 20:
+        description = html.escape(shorten(game_info['description'], length))
+        if len(description) <= room:
+            description = f"<i>{description}</i>\n\n"
+            break
+        description = ""
+        length -= 50
+    return header + description + footer
+
+def format_digest_message(games):
+    """Mensaje de Telegram con varios juegos a la vez"""
+    new_games = sum(1 for game_info in games if game_info.get('change', 'new') == 'new')
+    title = f"¡{len(games)} JUEGOS GRATIS!" if new_games == len(games) else f"{len(games)} CAMBIOS EN OFERTAS GRATIS"
+    lines = [f"🎮 <b>{title}</b> 🎮\n"]
+    for game_info in games:
+        regions = format_regions(game_info)
+        where = ", ".join(part for part in (game_info['platform'], regions, format_change(game_info)) if part)
+        lines.append(f"• <b>{html.escape(game_info['title'])}</b> ({where})\n  {game_info['url']}")
+    lines.append("\n⏰ <i>¡Aprovecha antes de que terminen las ofertas!</i>")
+    return "\n".join(lines)
+
+# =============================================================================
+# SUSCRIPTORES
+# =============================================================================
+
+def get_subscribers():
+    """Chats a los que se envían ofertas (TELEGRAM_CHAT_ID si no hay SUBSCRIBERS)"""
+    if SUBSCRIBERS:
+        return SUBSCRIBERS
+    return [{'chat_id': TELEGRAM_CHAT_ID}]
+
+def matches_subscriber(subscriber, platform, game_info):
+    """Aplica los filtros de tienda y palabras clave de un chat"""
+    platforms = subscriber.get('platforms')
+    if platforms and platform not in platforms:
+        return False
+    
+    title = game_info['title'].lower()
+    keywords = subscriber.get('keywords')
+    if keywords and not any(word.lower() in title for word in keywords):
+        return False
+    if any(word.lower() in title for word in subscriber.get('exclude_keywords', [])):
+        return False
+    return True
+
+# =============================================================================
+# IMÁGENES
+# =============================================================================
+
+# Extensión según los primeros bytes del archivo
+IMAGE_SIGNATURES = ((b'\xff\xd8', '.jpg'), (b'\x89PNG', '.png'), (b'RIFF', '.webp'), (b'GIF8', '.gif'))
+
+def image_extension(data):
+    """Extensión del archivo de imagen (.jpg si no se reconoce)"""
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    return '.jpg'
+
+def resize_image(data):
+    """Reduce la imagen a IMAGE_MAX_SIZE como JPEG. Sin Pillow se deja tal cual"""
+    try:
+        # Opcional: Pillow reduce las portadas antes de subirlas a Telegram
+        from PIL import Image
+    except ImportError:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= IMAGE_MAX_SIZE and image.format == 'JPEG':
+                return data
+            image.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE))
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+            return output.getvalue()
+    except (OSError, ValueError) as e:
+        print(f"      ⚠️  Imagen no válida, se usa sin cambios: {e}")
+        return data
+
+async def cache_image(url):
+    """
+    Devuelve (hash, archivo) de la portada de una URL, descargándola y
+    guardándola en IMAGE_CACHE_DIR si no está en caché. None si no se pudo.
+    """
+    db = get_notified_db()
+    row = db.execute("SELECT content_hash, file_name, fetched_at FROM images WHERE url = ?", (url,)).fetchone()
+    cached = row and os.path.exists(os.path.join(IMAGE_CACHE_DIR, row[1]))
+    if cached and time.time() - row[2] < IMAGE_CACHE_TTL:
+        inc_counter('freegames_cache_hits_total', {'cache': 'image'})
+        return row[0], row[1]
+    inc_counter('freegames_cache_misses_total', {'cache': 'image'})
+    
+    try:
+        # Una etiqueta por servidor de imágenes, no una serie de métricas por portada
+        response = await fetch(url, endpoint=f"image:{httpx.URL(url).host}")
+        if response.status_code != 200:
+            raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        print(f"      ⚠️  No se pudo descargar la portada {url}: {e}")
+        return (row[0], row[1]) if cached else None
+    
+    # Reducir la imagen no debe bloquear el bucle de eventos
+    data = await asyncio.to_thread(resize_image, response.content)
+    content_hash = hashlib.sha256(data).hexdigest()
+    file_name = content_hash + image_extension(data)
+    path = os.path.join(IMAGE_CACHE_DIR, file_name)
+    if not os.path.exists(path):
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    
+    with db:
+        db.execute("INSERT OR REPLACE INTO images (url, content_hash, file_name, fetched_at) VALUES (?, ?, ?, ?)",
+                   (url, content_hash, file_name, time.time()))
+    return content_hash, file_name
+
+def prune_image_cache():
+    """
+    Borra las portadas descargadas hace más de IMAGE_CACHE_TTL que ya no
+    usa ningún mensaje de la cola, sus archivos y los file_id que quedan sin imagen
+    """
+    db = get_notified_db()
+    queued = {json.loads(row[0]).get('image') for row in db.execute("SELECT payload FROM outbox")}
+    expired = [row[0] for row in db.execute(
+        "SELECT url FROM images WHERE fetched_at < ?", (time.time() - IMAGE_CACHE_TTL,)
+    ) if row[0] not in queued]
+    if not expired:
+        return
+    
+    with db:
+        db.executemany("DELETE FROM images WHERE url = ?", [(url,) for url in expired])
+        db.execute("DELETE FROM telegram_files WHERE content_hash NOT IN (SELECT content_hash FROM images)")
+    
+    # Varias URLs pueden compartir archivo: solo se borran los que nadie usa
+    in_use = {row[0] for row in db.execute("SELECT file_name FROM images")}
+    removed = 0
+    for file_name in os.listdir(IMAGE_CACHE_DIR) if os.path.isdir(IMAGE_CACHE_DIR) else []:
+        # Los .tmp pueden ser una descarga en curso del repartidor
+        if file_name not in in_use and not file_name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(IMAGE_CACHE_DIR, file_name))
+                removed += 1
+            except OSError as e:
+                print(f"⚠️  No se pudo borrar {file_name}: {e}")
+    print(f"🧹 Caché de portadas: {len(expired)} entradas y {removed} archivos eliminados")
+
+async def prepare_images(items):
+    """Descarga a la vez las portadas de varios mensajes. Devuelve {url: (hash, archivo)}"""
+    urls = list({item['game']['image'] for item in items if item['game'].get('image')})
+    results = await asyncio.gather(*(cache_image(url) for url in urls))
+    return {url: result for url, result in zip(urls, results) if result}
+
+def photo_inputs(images):
+    """
+    Foto a enviar de cada imagen: su file_id si ya se subió a Telegram y, si
+    no, el contenido del archivo (una ruta local se enviaría como file://, que
+    la API de Telegram no admite en los álbumes). Devuelve (fotos, imágenes
+    enviadas por file_id).
+    """
+    db = get_notified_db()
+    photos, reused = [], []
+    for content_hash, file_name in images:
+        row = db.execute("SELECT file_id FROM telegram_files WHERE content_hash = ?", (content_hash,)).fetchone()
+        if row:
+            photos.append(row[0])
+            reused.append((content_hash, file_name))
+        else:
+            photos.append(Path(IMAGE_CACHE_DIR, file_name).read_bytes())
+    return photos, reused
+
+def remember_file_ids(images, messages):
+    """Guarda el file_id de las fotos enviadas para no volver a subirlas"""
+    rows = [(image[0], message.photo[-1].file_id)
+            for image, message in zip(images, messages) if getattr(message, 'photo', None)]
+    with get_notified_db() as db:
+        db.executemany("INSERT OR REPLACE INTO telegram_files (content_hash, file_id) VALUES (?, ?)", rows)
+
+def forget_file_ids(images):
+    """Olvida file_ids que Telegram ha rechazado (se volverán a subir)"""
+    with get_notified_db() as db:
+        db.executemany("DELETE FROM telegram_files WHERE content_hash = ?", [(image[0],) for image in images])
+
+async def send_offers(bot, chat_id, games, images):
+    """
+    Envía un lote de ofertas: una foto con su texto si es una sola, un álbum
+    si son varias y todas tienen portada, y texto en los demás casos (o si
+    Telegram rechaza la imagen). Devuelve el (primer) mensaje enviado.
+    """
+    from telegram import InputMediaPhoto
+    from telegram.error import BadRequest
+    
+    covers = [images.get(game.get('image')) for game in games]
+    if RICH_NOTIFICATIONS and all(covers) and len(games) <= 10:
+        reused = []
+        try:
+            photos, reused = photo_inputs(covers)
+            if len(games) == 1:
+                message = await bot.send_photo(
+                    chat_id=chat_id,
+                    photo=photos[0],
+                    caption=format_game_message(games[0], TELEGRAM_CAPTION_LIMIT),
+                    parse_mode='HTML'
+                )
+                messages = [message]
+            else:
+                media = [InputMediaPhoto(media=photo,
+                                         caption=format_game_message(game, TELEGRAM_CAPTION_LIMIT),
+                                         parse_mode='HTML')
+                         for game, photo in zip(games, photos)]
+                messages = await bot.send_media_group(chat_id=chat_id, media=media)
+            remember_file_ids(covers, messages)
+            return messages[0]
+        except OSError as e:
+            print(f"⚠️  No se pudo leer la portada, se envía solo texto: {e}")
+        except BadRequest as e:
+            print(f"⚠️  Telegram rechazó la imagen, se envía solo texto: {e}")
+            # Solo se olvidan los file_id usados: lo subido como archivo no tenía
+            forget_file_ids(reused)
+    
+    text = format_game_message(games[0]) if len(games) == 1 else format_digest_message(games)
+    return await bot.send_message(
+        chat_id=chat_id,
+        text=text,
+        parse_mode='HTML',
+        disable_web_page_preview=len(games) > 1
+    )
 
 # =============================================================================
-# CONFIGURACIÓN
+# COLA DE ENVÍO A TELEGRAM
 # =============================================================================
-TELEGRAM_BOT_TOKEN = "TU_TOKEN_DE_BOT"  # Obtener de @BotFather
-TELEGRAM_CHAT_ID = "TU_CHAT_ID"  # Tu ID de chat o ID del canal
 
-# Archivo para guardar juegos ya notificados
-# Si existe /app/data (Docker), usa esa carpeta, sino usa el directorio del script
-if os.path.exists('/app/data'):
-    NOTIFIED_GAMES_FILE = '/app/data/notified_games.json'
-else:
-    SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-    NOTIFIED_GAMES_FILE = os.path.join(SCRIPT_DIR, "notified_games.json")
+_chat_next_send = {}
+_global_send_times = deque()
+_delivery_event = None
 
-# Intervalo de verificación (en segundos)
-CHECK_INTERVAL = 3600  # 1 hora
+def notification_key(game_info):
+    """
+    Clave del mensaje en la cola: el ID para ofertas nuevas (el mismo que en
+    notified_games) e ID, cambio y fecha de fin para ampliaciones y finales
+    """
+    change = game_info.get('change', 'new')
+    if change == 'new':
+        return str(game_info['id'])
+    return f"{game_info['id']}:{change}:{int(game_info.get('ends_at') or 0)}"
 
-# =============================================================================
-# FUNCIONES AUXILIARES
-# =============================================================================
+def enqueue_notification(chat_id, platform, game_info):
+    """
+    Añade un juego a la cola de envío. Devuelve False si ya estaba en cola.
+    No confirma la transacción (ver run_cycle).
+    """
+    cursor = get_notified_db().execute(
+        "INSERT OR IGNORE INTO outbox (chat_id, platform, game_id, payload, next_attempt_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (str(chat_id), platform, notification_key(game_info), json.dumps(game_info, ensure_ascii=False),
+         time.time())
+    )
+    return cursor.rowcount == 1
 
-def load_notified_games():
-    """Carga los juegos ya notificados desde archivo"""
-    if os.path.exists(NOTIFIED_GAMES_FILE):
-        with open(NOTIFIED_GAMES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"steam": {}, "epic": {}}
+def due_notifications():
+    """Mensajes de la cola cuyo envío ya toca, agrupados por chat"""
+    by_chat = {}
+    for row in get_notified_db().execute(
+            "SELECT id, chat_id, platform, game_id, payload, attempts FROM outbox "
+            "WHERE next_attempt_at <= ? ORDER BY id", (time.time(),)):
+        item = {'id': row[0], 'chat_id': row[1], 'platform': row[2], 'game_id': row[3],
+                'game': json.loads(row[4]), 'attempts': row[5]}
+        by_chat.setdefault(item['chat_id'], []).append(item)
+    return by_chat
 
-def save_notified_games(games_dict):
-    """Guarda los juegos notificados en archivo"""
-    with open(NOTIFIED_GAMES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(games_dict, f, ensure_ascii=False, indent=2)
+def count_pending_notifications():
+    """Mensajes que siguen en la cola de envío"""
+    return get_notified_db().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
 
-def clean_old_games(games_dict, days=7):
-    """Elimina juegos notificados hace más de X días"""
-    current_time = time.time()
-    max_age = days * 24 * 60 * 60  # Convertir días a segundos
+def next_notification_due():
+    """Momento (timestamp) del próximo reintento pendiente, o None"""
+    row = get_notified_db().execute("SELECT MIN(next_attempt_at) FROM outbox").fetchone()
+    return row[0]
+
+def complete_notifications(items):
+    """Saca de la cola los mensajes enviados y marca como notificadas las ofertas nuevas"""
+    with get_notified_db() as db:
+        db.executemany("DELETE FROM outbox WHERE id = ?", [(item['id'],) for item in items])
+        db.executemany(
+            "INSERT OR REPLACE INTO notified_games (chat_id, platform, game_id, notified_at) VALUES (?, ?, ?, ?)",
+            [(item['chat_id'], item['platform'], item['game_id'], time.time())
+             for item in items if item['game'].get('change', 'new') == 'new']
+        )
+
+def retry_notifications(items, delay=None):
+    """Reprograma mensajes fallidos con backoff exponencial (o la espera indicada)"""
+    now = time.time()
+    with get_notified_db() as db:
+        for item in items:
+            attempts = item['attempts'] + 1
+            if delay is None and attempts >= DELIVERY_MAX_ATTEMPTS:
+                print(f"❌ Se descarta tras {attempts} intentos: {item['game']['title']}")
+                db.execute("DELETE FROM outbox WHERE id = ?", (item['id'],))
+                # Una oferta nueva descartada queda registrada como fallida: así no se
+                # vuelve a encolar en el siguiente ciclo (hasta NOTIFIED_RETENTION_DAYS)
+                if item['game'].get('change', 'new') == 'new':
+                    db.execute(
+                        "INSERT OR REPLACE INTO notified_games (chat_id, platform, game_id, notified_at, failed) "
+                        "VALUES (?, ?, ?, ?, 1)",
+                        (item['chat_id'], item['platform'], item['game_id'], now)
+                    )
+                continue
+            wait = delay if delay is not None else backoff_delay(attempts, DELIVERY_BACKOFF_BASE, DELIVERY_BACKOFF_MAX)
+            db.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+                (attempts if delay is None else item['attempts'], now + wait, item['id'])
+            )
+
+async def wait_send_slot(chat_id):
+    """Espera hasta poder enviar al chat sin superar los límites de Telegram"""
+    delay = _chat_next_send.get(chat_id, 0) - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
     
-    cleaned = {"steam": {}, "epic": {}}
-    removed_count = {"steam": 0, "epic": 0}
+    while True:
+        now = time.monotonic()
+        while _global_send_times and now - _global_send_times[0] >= 1:
+            _global_send_times.popleft()
+        if len(_global_send_times) < TELEGRAM_GLOBAL_RATE:
+            break
+        await asyncio.sleep(1 - (now - _global_send_times[0]))
     
-    for platform in ["steam", "epic"]:
-        for game_id, notified_at in games_dict.get(platform, {}).items():
-            age = current_time - notified_at
-            if age < max_age:
-                cleaned[platform][game_id] = notified_at
-            else:
-                removed_count[platform] += 1
+    _global_send_times.append(time.monotonic())
+    is_group = str(chat_id).startswith(('-', '@'))
+    _chat_next_send[chat_id] = time.monotonic() + (TELEGRAM_GROUP_INTERVAL if is_group else TELEGRAM_CHAT_INTERVAL)
+
+def retry_after_seconds(error):
+    """Segundos de espera de un RetryAfter (int o timedelta según la versión)"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else retry_after
+
+async def deliver_chat(bot, chat_id, items, images=None):
+    """
+    Envía los mensajes pendientes de un chat, en resumen si son varios.
+    images: portadas ya descargadas ({url: (hash, archivo)})
+    """
+    from telegram.error import TelegramError, RetryAfter, NetworkError
     
-    total_removed = removed_count["steam"] + removed_count["epic"]
-    if total_removed > 0:
-        print(f"🧹 Limpieza: {removed_count['steam']} juegos de Steam y {removed_count['epic']} de Epic eliminados (más de {days} días)")
+    if len(items) >= DIGEST_MIN_OFFERS:
+        batches = [items[i:i + DIGEST_MAX_OFFERS] for i in range(0, len(items), DIGEST_MAX_OFFERS)]
+    else:
+        batches = [[item] for item in items]
+    
+    for index, batch in enumerate(batches):
+        if shutdown_flag:
+            # Lo que queda sigue en la cola y se envía al reiniciar
+            return
+        games = [item['game'] for item in batch]
+        
+        await wait_send_slot(chat_id)
+        started = time.perf_counter()
+        try:
+            result = await send_offers(bot, chat_id, games, images or {})
+        except RetryAfter as e:
+            # Control de flujo: se reintenta todo lo pendiente de este chat cuando diga Telegram
+            wait = retry_after_seconds(e)
+            print(f"⏳ Telegram pide esperar {wait}s antes de enviar a {chat_id}")
+            inc_counter('freegames_notifications_total', {'result': 'rate_limited'}, len(batch))
+            retry_notifications([item for rest in batches[index:] for item in rest], delay=wait)
+            _chat_next_send[chat_id] = time.monotonic() + wait
+            return
+        except NetworkError as e:
+            # Fallo de red: lo que queda también fallaría, se reprograma todo
+            print(f"❌ Error de red al enviar a Telegram: {e}")
+            inc_counter('freegames_notifications_total', {'result': 'failed'}, len(batch))
+            retry_notifications([item for rest in batches[index:] for item in rest])
+            return
+        except TelegramError as e:
+            print(f"❌ Error al enviar mensaje de Telegram: {e}")
+            inc_counter('freegames_notifications_total', {'result': 'failed'}, len(batch))
+            retry_notifications(batch)
+            continue
+        finally:
+            observe('freegames_telegram_send_duration_seconds', time.perf_counter() - started)
+        
+        complete_notifications(batch)
+        inc_counter('freegames_notifications_total', {'result': 'sent'}, len(batch))
+        titles = ", ".join(game['title'] for game in games)
+        print(f"✓ Notificación enviada: {titles} (Message ID: {result.message_id})")
+
+async def deliver_pending(bot):
+    """Envía todo lo que toca de la cola, con los chats en paralelo"""
+    by_chat = due_notifications()
+    images = {}
+    if RICH_NOTIFICATIONS and by_chat:
+        images = await prepare_images([item for items in by_chat.values() for item in items])
+    await asyncio.gather(*(deliver_chat(bot, chat_id, items, images) for chat_id, items in by_chat.items()))
+
+def wake_delivery():
+    """Avisa al repartidor de que hay mensajes nuevos en la cola"""
+    if _delivery_event is not None:
+        _delivery_event.set()
+
+async def delivery_worker(bot):
+    """Tarea en segundo plano que vacía la cola de envío"""
+    global _delivery_event
+    _delivery_event = asyncio.Event()
     
-    return cleaned
+    while not shutdown_flag:
+        _delivery_event.clear()
+        try:
+            await deliver_pending(bot)
+        except Exception as e:
+            print(f"❌ Error en la cola de envío: {e}")
+        
+        next_due = next_notification_due()
+        timeout = None if next_due is None else max(1, next_due - time.time())
+        try:
+            await asyncio.wait_for(_delivery_event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
 # =============================================================================
-# STEAM
+# PLANIFICACIÓN
 # =============================================================================
 
-def check_steam_via_steamdb():
+# Momentos (timestamps) en los que empieza o termina una promoción conocida
+_schedule_events = set()
+_idle_cycles = 0
+
+# Estado del bucle principal (para /status)
+_status = {'started_at': time.time()}
+
+# Despierta la espera entre ciclos (/check_now, /interval, recarga de config)
+_wake_event = None
+_check_requested = False
+
+def add_schedule_events(events):
+    """Registra fechas de cambio de promoción anunciadas por una tienda"""
+    _schedule_events.update(events)
+
+def next_check_delay(found_new):
     """
-    Busca juegos con 100% de descuento en Steam usando múltiples métodos
+    Segundos hasta la próxima verificación y el motivo:
+    - justo después del inicio de la siguiente promoción conocida,
+    - cada MIN_CHECK_INTERVAL cerca de un cambio de promoción,
+    - y cada vez más espaciado (hasta MAX_CHECK_INTERVAL) si no hay novedades.
     """
-    free_games = []
-    found_ids = set()
+    global _idle_cycles
+    _idle_cycles = 0 if found_new else _idle_cycles + 1
+    now = time.time()
     
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        
-        print(f"   🔍 Método 1: Featured API")
-        # Método 1: Steam Featured
-        url = "https://store.steampowered.com/api/featured/"
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            for category in ['large_capsules', 'featured_win', 'featured_mac', 'featured_linux']:
-                if category in data:
-                    print(f"      - Categoría {category}: {len(data[category])} juegos")
-                    for game in data[category]:
-                        discount = game.get('discount_percent', 0)
-                        if discount > 0:
-                            print(f"        · {game.get('name')}: {discount}% descuento")
-                        
-                        if discount == 100:
-                            app_id = game.get('id')
-                            if app_id and str(app_id) not in found_ids:
-                                is_f2p = is_game_free_to_play(app_id)
-                                print(f"        ✓ 100% descuento! F2P: {is_f2p}")
-                                
-                                if not is_f2p:
-                                    found_ids.add(str(app_id))
-                                    free_games.append({
-                                        'title': game.get('name', 'Desconocido'),
-                                        'url': f"https://store.steampowered.com/app/{app_id}",
-                                        'id': str(app_id),
-                                        'platform': 'Steam'
-                                    })
-        else:
-            print(f"      ❌ Error HTTP {response.status_code}")
-        
-        print(f"   🔍 Método 2: Búsqueda de especiales (HTML)")
-        # Método 2: Búsqueda directa parseando HTML
-        search_url = "https://store.steampowered.com/search/results/"
-        params = {
-            'query': '',
-            'start': 0,
-            'count': 50,
-            'maxprice': 'free',
-            'specials': 1,
-            'ndl': 1
-        }
-        
-        response = requests.get(search_url, params=params, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            html = response.text
-            app_ids = re.findall(r'data-ds-appid="(\d+)"', html)
-            
-            print(f"      - App IDs encontrados: {len(app_ids)}")
-            
-            if app_ids:
-                for app_id in app_ids[:10]:
-                    if str(app_id) not in found_ids:
-                        details = get_game_details(app_id)
-                        if details:
-                            name = details.get('name', 'Desconocido')
-                            original_price = details.get('original_price', 0)
-                            final_price = details.get('final_price', 0)
-                            is_f2p = details.get('is_free', False)
-                            
-                            print(f"        · {name}: Final={final_price}, Original={original_price}, F2P={is_f2p}")
-                            
-                            # Si aparece en búsqueda "maxprice=free" con precio original > 0
-                            # O si final_price = 0 y original_price > 0
-                            # Entonces es una promoción temporal gratuita
-                            if original_price > 0:
-                                # Tiene precio original, así que no es F2P permanente
-                                found_ids.add(str(app_id))
-                                free_games.append({
-                                    'title': name,
-                                    'url': f"https://store.steampowered.com/app/{app_id}",
-                                    'id': str(app_id),
-                                    'platform': 'Steam'
-                                })
-                                print(f"          ✅ GRATIS TEMPORAL (aparece en búsqueda de gratis)!")
-                        else:
-                            print(f"        · ID {app_id}: Sin detalles")
-            else:
-                print(f"      ℹ️ No se encontraron IDs en HTML")
-        else:
-            print(f"      ❌ Error HTTP {response.status_code}")
-        
-        print(f"   🔍 Método 3: Featured Categories")
-        search_url = "https://store.steampowered.com/api/featuredcategories/"
-        response = requests.get(search_url, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            categories = ['specials', 'coming_soon', 'top_sellers', 'new_releases']
-            for category in categories:
-                if category in data:
-                    items = data[category].get('items', []) if isinstance(data[category], dict) else data[category]
-                    if items:
-                        print(f"      - Categoría {category}: {len(items)} juegos")
-                        for game in items:
-                            discount = game.get('discount_percent', 0)
-                            if discount == 100:
-                                app_id = game.get('id')
-                                if app_id and str(app_id) not in found_ids:
-                                    is_f2p = is_game_free_to_play(app_id)
-                                    print(f"        ✓ {game.get('name')}: 100% descuento! F2P: {is_f2p}")
-                                    
-                                    if not is_f2p:
-                                        found_ids.add(str(app_id))
-                                        free_games.append({
-                                            'title': game.get('name', 'Desconocido'),
-                                            'url': f"https://store.steampowered.com/app/{app_id}",
-                                            'id': str(app_id),
-                                            'platform': 'Steam'
-                                        })
-        else:
-            print(f"      ❌ Error HTTP {response.status_code}")
+    for event in [e for e in _schedule_events if e < now - ROTATION_WINDOW]:
+        _schedule_events.discard(event)
     
-    except Exception as e:
-        print(f"   ❌ Error al verificar Steam: {e}")
-        import traceback
-        traceback.print_exc()
+    if any(abs(now - event) < ROTATION_WINDOW for event in _schedule_events):
+        delay, reason = MIN_CHECK_INTERVAL, "cambio de promoción cercano"
+    else:
+        delay = min(CHECK_INTERVAL * 2 ** max(0, _idle_cycles - 1), MAX_CHECK_INTERVAL)
+        reason = "intervalo normal" if delay == CHECK_INTERVAL else f"{_idle_cycles} ciclos sin novedades"
     
-    print(f"   📊 Total juegos gratis encontrados en Steam: {len(free_games)}")
-    return free_games
-
-def is_game_free_to_play(app_id):
-    """Verifica si un juego es Free-to-Play en Steam"""
-    try:
-        url = f"https://store.steampowered.com/api/appdetails?appids={app_id}"
-        response = requests.get(url, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if str(app_id) in data and data[str(app_id)]['success']:
-                game_data = data[str(app_id)]['data']
-                return game_data.get('is_free', False)
-    except:
-        pass
+    upcoming = [event for event in _schedule_events if event > now]
+    if upcoming and min(upcoming) - now + ROTATION_DELAY < delay:
+        delay = min(upcoming) - now + ROTATION_DELAY
+        reason = f"promoción a las {datetime.fromtimestamp(min(upcoming)).strftime('%Y-%m-%d %H:%M')}"
     
-    return False
+    return max(int(delay), 1), reason
 
-def get_game_details(app_id):
-    """Obtiene detalles completos de un juego de Steam incluyendo precio"""
-    try:
-        url = f"https://store.steampowered.com/api/appdetails?appids={app_id}&cc=es&l=spanish"
-        response = requests.get(url, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if str(app_id) in data and data[str(app_id)]['success']:
-                game_data = data[str(app_id)]['data']
-                
-                # Obtener información de precio
-                price_overview = game_data.get('price_overview', {})
-                
-                return {
-                    'name': game_data.get('name', 'Desconocido'),
-                    'is_free': game_data.get('is_free', False),
-                    'final_price': price_overview.get('final', 0),
-                    'original_price': price_overview.get('initial', 0),
-                    'discount_percent': price_overview.get('discount_percent', 0)
-                }
-    except:
-        pass
+def request_check():
+    """Adelanta la próxima verificación a ahora mismo (/check_now)"""
+    global _check_requested
+    _check_requested = True
+    reschedule()
+
+def reschedule():
+    """Recalcula la espera en curso (p. ej. tras cambiar CHECK_INTERVAL)"""
+    if _wake_event is not None:
+        _wake_event.set()
+
+async def wait_next_check(last_check, delay):
+    """
+    Espera hasta last_check + delay. Termina antes si se pide una
+    verificación o si CHECK_INTERVAL baja por debajo de lo que falta.
+    """
+    global _wake_event, _check_requested
+    if _wake_event is None:
+        _wake_event = asyncio.Event()
     
-    return None
+    deadline = last_check + delay
+    while not _check_requested and not shutdown_flag:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        _wake_event.clear()
+        try:
+            await asyncio.wait_for(_wake_event.wait(), timeout=remaining)
+        except asyncio.TimeoutError:
+            break
+        deadline = min(deadline, last_check + CHECK_INTERVAL)
+    _check_requested = False
 
 # =============================================================================
-# EPIC GAMES
+# CONFIGURACIÓN EN CALIENTE
 # =============================================================================
 
-def check_epic_free_games():
+# Constantes que se pueden cambiar por entorno o en CONFIG_FILE
+CONFIG_SETTINGS = (
+    'TELEGRAM_BOT_TOKEN', 'TELEGRAM_CHAT_ID', 'SUBSCRIBERS', 'COMMAND_CHAT_IDS',
+    'NOTIFIED_RETENTION_DAYS', 'NOTIFY_CHANGES', 'OFFER_END_MISSES', 'REGIONS', 'EPIC_LOCALE', 'STEAM_LANGUAGE',
+    'CHECK_INTERVAL', 'MIN_CHECK_INTERVAL', 'MAX_CHECK_INTERVAL',
+    'DIGEST_MIN_OFFERS', 'DIGEST_MAX_OFFERS',
+)
+
+# Los valores escritos en el script son los valores por defecto
+_default_settings = {name: globals()[name] for name in CONFIG_SETTINGS}
+
+# Cambios que requieren reiniciar (el bot de Telegram ya está creado)
+RESTART_SETTINGS = ('TELEGRAM_BOT_TOKEN',)
+
+# Ajustes cambiados con comandos (tienen prioridad hasta que cambie el archivo)
+_runtime_settings = {}
+
+# Valor mínimo de los ajustes numéricos (por defecto, 1)
+SETTING_MINIMUMS = {
+    'CHECK_INTERVAL': CHECK_INTERVAL_FLOOR,
+    'MIN_CHECK_INTERVAL': CHECK_INTERVAL_FLOOR,
+    'MAX_CHECK_INTERVAL': CHECK_INTERVAL_FLOOR,
+}
+
+def coerce_setting(name, value):
+    """Convierte un valor del entorno o del archivo al tipo del valor por defecto"""
+    default = _default_settings[name]
+    if isinstance(default, str):
+        return str(value)
+    if isinstance(value, str):
+        value = json.loads(value)  # Números y listas en JSON: REGIONS='["ES", "MX"]'
+    if isinstance(default, int):
+        minimum = SETTING_MINIMUMS.get(name, 1)
+        if isinstance(value, bool) or int(value) < minimum:
+            raise ValueError(f"se esperaba un número mayor o igual que {minimum}, no {value!r}")
+        return int(value)
+    if not isinstance(value, type(default)):
+        raise ValueError(f"se esperaba {type(default).__name__}, no {type(value).__name__}")
+    if name == 'SUBSCRIBERS':
+        for subscriber in value:
+            validate_subscriber(subscriber)
+    return value
+
+def validate_subscriber(subscriber):
+    """Comprueba una entrada de SUBSCRIBERS antes de aceptarla en una recarga"""
+    if not isinstance(subscriber, dict) or subscriber.get('chat_id') in (None, ''):
+        raise ValueError(f"cada suscriptor necesita un 'chat_id', no {subscriber!r}")
+    for key in ('platforms', 'keywords', 'exclude_keywords'):
+        words = subscriber.get(key, [])
+        if not isinstance(words, list) or not all(isinstance(word, str) for word in words):
+            raise ValueError(f"'{key}' debe ser una lista de textos (chat {subscriber['chat_id']})")
+
+def config_mtime():
+    """Fecha de modificación de CONFIG_FILE (None si no existe)"""
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+def load_config():
     """
-    Busca juegos gratuitos en Epic Games Store
+    Aplica, en este orden, los valores por defecto, las variables de entorno,
+    CONFIG_FILE y los cambios hechos con comandos. Devuelve los nombres que
+    han cambiado. Si el archivo no se puede leer se mantiene lo que había.
     """
-    free_games = []
+    settings = dict(_default_settings)
+    settings.update({name: os.environ[name] for name in CONFIG_SETTINGS if name in os.environ})
     
-    try:
-        url = "https://store-site-backend-static.ak.epicgames.com/freeGamesPromotions"
-        params = {
-            'locale': 'es-ES',
-            'country': 'ES',
-            'allowCountries': 'ES'
-        }
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            if 'data' in data and 'Catalog' in data['data']:
-                games = data['data']['Catalog']['searchStore']['elements']
-                print(f"   📊 Epic: {len(games)} juegos encontrados en total")
-                
-                for game in games:
-                    # Verificar si está gratis actualmente
-                    promotions = game.get('promotions')
-                    if promotions:
-                        promo_offers = promotions.get('promotionalOffers')
-                        
-                        if promo_offers and len(promo_offers) > 0:
-                            offers = promo_offers[0].get('promotionalOffers', [])
-                            
-                            if len(offers) > 0:
-                                # Verificar precio
-                                price_info = game.get('price', {}).get('totalPrice', {})
-                                original_price = price_info.get('originalPrice', 0)
-                                current_price = price_info.get('discountPrice', 0)
-                                
-                                title = game.get('title', 'Desconocido')
-                                print(f"   🔍 {title}: Original={original_price}, Actual={current_price}")
-                                
-                                # Gratis temporalmente (precio original > 0, actual = 0)
-                                if original_price > 0 and current_price == 0:
-                                    game_id = game.get('id')
-                                    
-                                    free_games.append({
-                                        'title': title,
-                                        'url': f"https://store.epicgames.com/es-ES/free-games",
-                                        'id': game_id,
-                                        'platform': 'Epic Games'
-                                    })
-                                    print(f"   ✅ Juego gratis detectado: {title}")
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                file_settings = json.load(f)
+            if not isinstance(file_settings, dict):
+                raise ValueError("debe ser un objeto JSON")
+        except (OSError, ValueError) as e:
+            print(f"⚠️  No se pudo leer {CONFIG_FILE}: {e}")
+            return []
+        for name, value in file_settings.items():
+            if name in CONFIG_SETTINGS:
+                settings[name] = value
+            else:
+                print(f"⚠️  {CONFIG_FILE}: '{name}' no es un ajuste configurable, se ignora")
     
-    except Exception as e:
-        print(f"   ❌ Error al verificar Epic Games: {e}")
-        import traceback
-        traceback.print_exc()
+    settings.update(_runtime_settings)
     
-    return free_games
+    values = {}
+    for name, value in settings.items():
+        try:
+            values[name] = coerce_setting(name, value)
+        except (ValueError, TypeError) as e:
+            print(f"⚠️  Valor no válido para {name}: {e}")
+            values[name] = globals()[name]
+    
+    # El intervalo normal queda dentro de los límites del intervalo adaptativo
+    low, high = values['MIN_CHECK_INTERVAL'], max(values['MIN_CHECK_INTERVAL'], values['MAX_CHECK_INTERVAL'])
+    interval = min(max(values['CHECK_INTERVAL'], low), high)
+    if interval != values['CHECK_INTERVAL']:
+        print(f"⚠️  CHECK_INTERVAL={values['CHECK_INTERVAL']}s fuera de {low}s-{high}s, se usa {interval}s")
+        values['CHECK_INTERVAL'] = interval
+    
+    changed = []
+    for name, value in values.items():
+        if globals()[name] != value:
+            globals()[name] = value
+            changed.append(name)
+    return changed
+
+def apply_config_changes(changed):
+    """Avisa de los ajustes recargados y replanifica si cambió el intervalo"""
+    if not changed:
+        return
+    print(f"🔧 Configuración recargada: {', '.join(changed)}")
+    for name in changed:
+        if name in RESTART_SETTINGS:
+            print(f"   ⚠️  {name} se aplicará al reiniciar el bot")
+    if any(name.endswith('CHECK_INTERVAL') for name in changed):
+        reschedule()
+
+async def config_watcher():
+    """Tarea en segundo plano que recarga CONFIG_FILE cuando cambia"""
+    last_mtime = config_mtime()
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        mtime = config_mtime()
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        # Los cambios del archivo sustituyen a los hechos con comandos
+        _runtime_settings.clear()
+        apply_config_changes(load_config())
 
 # =============================================================================
-# TELEGRAM
+# COMANDOS DE TELEGRAM
 # =============================================================================
 
-async def test_telegram_connection(bot):
-    """Prueba la conexión con Telegram y envía un mensaje de prueba"""
+def command_chats():
+    """Chats autorizados a usar comandos"""
+    chats = COMMAND_CHAT_IDS or [subscriber['chat_id'] for subscriber in get_subscribers()]
+    return {str(chat_id) for chat_id in chats}
+
+def format_timestamp(timestamp):
+    """Fecha legible de un timestamp"""
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+
+def metric_total(name, **labels):
+    """Suma de las series de una métrica que tienen las etiquetas indicadas"""
+    wanted = set((key, str(value)) for key, value in labels.items())
+    return sum(value for (metric, series), value in _metric_values.items()
+               if metric == name and wanted <= set(series))
+
+def status_message():
+    """Respuesta a /status"""
+    lines = [
+        "🤖 <b>Estado del bot</b>\n",
+        f"<b>En marcha desde:</b> {format_timestamp(_status['started_at'])}",
+    ]
+    if 'last_cycle_at' in _status:
+        lines.append(f"<b>Último ciclo:</b> {format_timestamp(_status['last_cycle_at'])} "
+                     f"({_status['last_cycle_new']} mensajes nuevos)")
+    if 'next_check_at' in _status:
+        lines.append(f"<b>Próxima verificación:</b> {format_timestamp(_status['next_check_at'])} "
+                     f"({html.escape(_status['next_check_reason'])})")
+    lines.append(f"<b>Intervalo:</b> {CHECK_INTERVAL}s (entre {MIN_CHECK_INTERVAL}s y {MAX_CHECK_INTERVAL}s)")
+    lines.append(f"<b>Mensajes en cola:</b> {count_pending_notifications()}")
+    if len(_cluster['workers']) > 1:
+        lines.append(f"<b>Workers:</b> {len(_cluster['workers'])} (este consulta: "
+                     f"{', '.join(provider_name(key) for key in assigned_providers()) or 'ninguna tienda'})")
+    open_breakers = [endpoint for endpoint, breaker in _breakers.items() if breaker['open_until'] > time.time()]
+    lines.append(f"<b>Endpoints en pausa:</b> {html.escape(', '.join(open_breakers)) or 'ninguno'}")
+    return "\n".join(lines)
+
+def stats_message():
+    """Respuesta a /stats"""
+    lines = ["📊 <b>Estadísticas</b>\n"]
+    for key, count in count_notified().items():
+        found = len(_last_good_offers.get(key, []))
+        lines.append(f"<b>{provider_name(key)}:</b> {found} ofertas en el último ciclo, {count} registradas")
+    lines.append(f"<b>Notificaciones enviadas:</b> {metric_total('freegames_notifications_total', result='sent')}")
+    lines.append(f"<b>Notificaciones fallidas:</b> {metric_total('freegames_notifications_total', result='failed')}")
+    lines.append(f"<b>Errores de tiendas:</b> {metric_total('freegames_provider_errors_total')}")
+    return "\n".join(lines)
+
+def interval_message(args):
+    """Respuesta a /interval [segundos]: muestra o cambia CHECK_INTERVAL"""
+    if not args:
+        return f"⏱️ Intervalo actual: {CHECK_INTERVAL}s. Uso: /interval &lt;segundos&gt;"
     try:
-        print("\n🔧 Probando conexión con Telegram...")
-        
-        # Obtener info del bot
-        bot_info = await bot.get_me()
-        print(f"✓ Bot conectado: @{bot_info.username}")
-        
-        # Intentar enviar mensaje de prueba
-        test_message = "🤖 Bot de juegos gratis iniciado correctamente.\n\n✅ Las notificaciones llegarán aquí."
-        
-        result = await bot.send_message(
-            chat_id=TELEGRAM_CHAT_ID,
-            text=test_message,
-            parse_mode='HTML'
-        )
-        
-        print(f"✓ Mensaje de prueba enviado correctamente (ID: {result.message_id})")
-        print(f"✓ Chat ID verificado: {TELEGRAM_CHAT_ID}")
-        return True
-        
-    except TelegramError as e:
-        print(f"❌ Error de Telegram: {e}")
-        
-        if "Unauthorized" in str(e):
-            print("   → El token del bot es inválido. Verifica con @BotFather")
-        elif "chat not found" in str(e) or "Bad Request" in str(e):
-            print("   → El Chat ID es incorrecto o el bot no puede enviarte mensajes")
-            print("   → SOLUCIÓN: Envía un mensaje a tu bot primero (cualquier mensaje)")
-            print("   → O usa @userinfobot para verificar tu Chat ID")
-        
-        return False
-    except Exception as e:
-        print(f"❌ Error inesperado: {e}")
-        return False
+        value = coerce_setting('CHECK_INTERVAL', args[0])
+        if not MIN_CHECK_INTERVAL <= value <= MAX_CHECK_INTERVAL:
+            raise ValueError(value)
+    except (ValueError, TypeError):
+        return f"❌ El intervalo debe estar entre {MIN_CHECK_INTERVAL} y {MAX_CHECK_INTERVAL} segundos"
+    
+    _runtime_settings['CHECK_INTERVAL'] = value
+    apply_config_changes(load_config())
+    return f"✅ Intervalo cambiado a {CHECK_INTERVAL}s (hasta reiniciar o cambiar {os.path.basename(CONFIG_FILE)})"
 
-async def send_telegram_message(bot, game_info):
-    """Envía un mensaje de Telegram con la info del juego"""
+def history_message(args):
+    """Respuesta a /history [días]: promociones gratis de los últimos días"""
     try:
-        message = (
-            f"🎮 <b>¡JUEGO GRATIS!</b> 🎮\n\n"
-            f"<b>Título:</b> {game_info['title']}\n"
-            f"<b>Plataforma:</b> {game_info['platform']}\n"
-            f"<b>Enlace:</b> {game_info['url']}\n\n"
-            f"⏰ <i>¡Aprovecha antes de que termine la oferta!</i>"
-        )
-        
-        result = await bot.send_message(
-            chat_id=TELEGRAM_CHAT_ID,
-            text=message,
-            parse_mode='HTML',
-            disable_web_page_preview=False
-        )
-        
-        print(f"✓ Notificación enviada: {game_info['title']} (Message ID: {result.message_id})")
-        return True
+        days = int(args[0]) if args else 30
+    except ValueError:
+        return "❌ Uso: /history [días]"
+    
+    offers = offers_between(time.time() - days * 24 * 60 * 60)
+    if not offers:
+        return f"📜 No hubo juegos gratis en los últimos {days} días"
+    lines = [f"📜 <b>{len(offers)} juegos gratis en los últimos {days} días</b>\n"]
+    for offer in offers[:50]:
+        started = datetime.fromtimestamp(offer['starts_at']).strftime('%Y-%m-%d')
+        state = "activa" if offer['ended_at'] is None else "terminada"
+        lines.append(f"• {started} <b>{html.escape(offer['title'])}</b> ({provider_name(offer['platform'])}, {state})")
+    return "\n".join(lines)
+
+def check_now_message(args):
+    """Respuesta a /check_now (también la atienden los demás workers)
+    
+    Entre dos verificaciones forzadas pasan al menos MIN_CHECK_INTERVAL segundos:
+    cualquier miembro de un grupo autorizado puede enviar el comando.
+    """
+    requested_at = time.time()
+    wait = get_state('check_requested_at', 0) + MIN_CHECK_INTERVAL - requested_at
+    if wait > 0:
+        return f"⏳ Ya se forzó una verificación hace poco, inténtalo de nuevo en {int(wait) + 1}s"
+    _cluster['check_seen_at'] = requested_at
+    set_state('check_requested_at', requested_at)
+    request_check()
+    return "🔄 Verificación en marcha"
+
+# comando -> función(argumentos) que devuelve el texto de respuesta
+COMMANDS = {
+    '/status': lambda args: status_message(),
+    '/check_now': check_now_message,
+    '/interval': interval_message,
+    '/stats': lambda args: stats_message(),
+    '/history': history_message,
+}
+
+def handle_command(text):
+    """Respuesta a un mensaje con comando, o None si no es un comando conocido"""
+    parts = text.split()
+    if not parts:
+        return None
+    command = parts[0].split('@')[0].lower()  # /status@MiBot en grupos
+    if command not in COMMANDS:
+        return None
+    print(f"💬 Comando recibido: {command}")
+    return COMMANDS[command](parts[1:])
+
+async def command_listener(bot):
+    """Tarea en segundo plano que atiende los comandos (long polling)"""
+    from telegram.error import TelegramError, RetryAfter
+    
+    offset = None
+    failures = 0
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                timeout=COMMAND_POLL_TIMEOUT,
+                allowed_updates=['message', 'channel_post']
+            )
+            failures = 0
+        except RetryAfter as e:
+            await asyncio.sleep(retry_after_seconds(e))
+            continue
+        except TelegramError as e:
+            failures += 1
+            delay = backoff_delay(failures, 5, 300)
+            print(f"❌ Error al leer comandos de Telegram: {e} (reintento en {int(delay)}s)")
+            await asyncio.sleep(delay)
+            continue
         
-    except TelegramError as e:
-        print(f"❌ Error al enviar mensaje de Telegram: {e}")
-        return False
+        for update in updates:
+            offset = update.update_id + 1
+            message = update.effective_message
+            if message is None or not message.text:
+                continue
+            try:
+                if str(message.chat_id) not in command_chats():
+                    continue
+                reply = handle_command(message.text)
+            except Exception as e:
+                reply = f"❌ Error: {html.escape(str(e))}"
+            if reply is None:
+                continue
+            
+            await wait_send_slot(str(message.chat_id))
+            try:
+                await bot.send_message(chat_id=message.chat_id, text=reply, parse_mode='HTML')
+            except TelegramError as e:
+                print(f"❌ Error al responder al comando: {e}")
 
 # =============================================================================
 # SEÑALES Y CIERRE LIMPIO
 # =============================================================================
 
 shutdown_flag = False
+_shutdown_event = None
+_shutdown_deadline = None
 
-def signal_handler(sig, frame):
-    """Manejador para cierre limpio del bot"""
-    global shutdown_flag
-    print("\n\n⚠️  Bot detenido por el usuario")
-    print("🔄 Cerrando conexiones...")
+def request_shutdown():
+    """
+    Pide el cierre limpio: no se empiezan ciclos ni envíos nuevos y lo que
+    está en curso tiene SHUTDOWN_TIMEOUT segundos para terminar
+    """
+    global shutdown_flag, _shutdown_deadline
+    if shutdown_flag:
+        return
     shutdown_flag = True
-    sys.exit(0)
+    _shutdown_deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    print("\n\n⚠️  Bot detenido por el usuario")
+    print(f"🔄 Terminando lo que está en curso (máximo {SHUTDOWN_TIMEOUT}s)...")
+    if _shutdown_event is not None:
+        _shutdown_event.set()
+    reschedule()
+    wake_delivery()
+
+def shutdown_time_left():
+    """Segundos que quedan para terminar lo que está en curso al cerrar"""
+    if _shutdown_deadline is None:
+        return SHUTDOWN_TIMEOUT
+    return max(_shutdown_deadline - time.monotonic(), 0)
+
+def install_signal_handlers():
+    """Atiende SIGINT y SIGTERM desde el bucle de eventos"""
+    global _shutdown_event
+    _shutdown_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown)
+        except NotImplementedError:
+            # Windows: el manejador clásico solo avisa al bucle
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(request_shutdown))
+
+async def finish_or_cancel(task):
+    """
+    Espera a una tarea. Si se pide el cierre mientras tanto, le deja el
+    tiempo que quede de SHUTDOWN_TIMEOUT y después la cancela.
+    """
+    if _shutdown_event is not None:
+        shutdown_wait = asyncio.create_task(_shutdown_event.wait())
+        try:
+            await asyncio.wait({task, shutdown_wait}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            shutdown_wait.cancel()
+        if not task.done():
+            await asyncio.wait({task}, timeout=shutdown_time_left())
+            if not task.done():
+                print(f"⏱️  No terminó en {SHUTDOWN_TIMEOUT}s: se cancela y se retomará al reiniciar")
+                task.cancel()
+    return await task
+
+# =============================================================================
+# PUNTO DE CONTROL DEL CICLO
+# =============================================================================
+
+async def check_providers_resumable(keys, state_key):
+    """
+    Ejecuta en paralelo las tiendas keys y devuelve {clave: ofertas}. Guarda
+    en bot_state[state_key] lo que devuelve cada tienda. Si el bot se reinicia
+    a mitad de ciclo, solo se consultan las tiendas que faltaban.
+    """
+    checkpoint = get_state(state_key)
+    if checkpoint and time.time() - checkpoint['started_at'] <= CHECKPOINT_MAX_AGE:
+        done = {key: offers for key, offers in checkpoint['offers'].items() if key in keys}
+        if done:
+            names = ", ".join(provider_name(key) for key in done)
+            print(f"♻️  Se retoma el ciclo interrumpido (ya consultado: {names})")
+        incomplete = set(checkpoint.get('incomplete', []))
+        for key in done:
+            if key in incomplete:
+                _incomplete_providers.add(key)
+            else:
+                _last_good_offers[key] = done[key]
+                _incomplete_providers.discard(key)
+    else:
+        checkpoint = {'started_at': time.time(), 'offers': {}, 'incomplete': []}
+        set_state(state_key, checkpoint)
+        done = {}
+    
+    async def run_and_save(key):
+        offers = await run_provider(key)
+        checkpoint['offers'][key] = offers
+        if key in _incomplete_providers:
+            checkpoint.setdefault('incomplete', []).append(key)
+        set_state(state_key, checkpoint)
+        return offers
+    
+    pending = [key for key in keys if key not in done]
+    results = dict(zip(pending, await asyncio.gather(*(run_and_save(key) for key in pending))))
+    return {key: done[key] if key in done else results[key] for key in keys}
+
+# =============================================================================
+# VARIOS WORKERS: LÍDER Y REPARTO DE TIENDAS
+# =============================================================================
+
+# Workers vivos (ordenados), si este es el líder y el último /check_now atendido
+_cluster = {'workers': [WORKER_ID], 'leader': False, 'renewed_at': 0, 'check_seen_at': time.time()}
+
+def renew_membership():
+    """
+    Renueva el latido de este worker y su lease de líder, o se queda con el
+    lease si el líder anterior no lo ha renovado. Devuelve True si es el líder.
+    """
+    now = time.time()
+    with get_notified_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("INSERT OR REPLACE INTO workers (worker_id, heartbeat_at) VALUES (?, ?)", (WORKER_ID, now))
+        db.execute("DELETE FROM workers WHERE heartbeat_at < ?", (now - LEASE_TTL,))
+        db.execute("""
+            INSERT INTO leases (name, holder, expires_at) VALUES ('leader', ?, ?)
+            ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+        """, (WORKER_ID, now + LEASE_TTL, now))
+        holder = db.execute("SELECT holder FROM leases WHERE name = 'leader'").fetchone()[0]
+        workers = [row[0] for row in db.execute("SELECT worker_id FROM workers ORDER BY worker_id")]
+    _cluster.update(workers=workers, leader=holder == WORKER_ID, renewed_at=now)
+    return _cluster['leader']
+
+def leave_cluster():
+    """Sale del grupo al apagar y suelta el lease para que el relevo sea inmediato"""
+    with get_notified_db() as db:
+        db.execute("DELETE FROM workers WHERE worker_id = ?", (WORKER_ID,))
+        db.execute("DELETE FROM leases WHERE name = 'leader' AND holder = ?", (WORKER_ID,))
+    _cluster['leader'] = False
+
+def assigned_providers():
+    """Tiendas que consulta este worker (reparto por turnos entre los workers vivos)"""
+    workers = _cluster['workers'] if WORKER_ID in _cluster['workers'] else [WORKER_ID]
+    return [key for index, key in enumerate(sorted(PROVIDERS)) if workers[index % len(workers)] == WORKER_ID]
+
+def shard_state_key(name, keys=None):
+    """Clave de bot_state propia de un reparto de tiendas ('cycle:epic,steam')"""
+    return f"{name}:{','.join(assigned_providers() if keys is None else keys)}"
+
+async def cluster_worker():
+    """
+    Tarea en segundo plano: mantiene el latido y el lease. Mientras este
+    worker es el líder ejecuta el repartidor de la cola y los comandos
+    (solo entonces se crea el bot de Telegram).
+    """
+    leader_tasks = []
+    assigned = assigned_providers()
+    try:
+        while not shutdown_flag:
+            try:
+                leader = renew_membership()
+            except sqlite3.Error as e:
+                # Sin renovar, el lease sigue siendo válido hasta que caduque
+                print(f"⚠️  No se pudo renovar el lease: {e}")
+                leader = _cluster['leader'] and time.time() - _cluster['renewed_at'] < LEASE_TTL
+            
+            if leader and not leader_tasks:
+                print(f"👑 Worker {WORKER_ID}: ahora es el líder (envía a Telegram y atiende comandos)")
+                leader_tasks = [asyncio.create_task(delivery_worker(get_bot()))]
+                if TELEGRAM_COMMANDS:
+                    leader_tasks.append(asyncio.create_task(command_listener(get_bot())))
+            elif not leader and leader_tasks:
+                print(f"⚠️  Worker {WORKER_ID}: ya no es el líder")
+                for task in leader_tasks:
+                    task.cancel()
+                leader_tasks = []
+            
+            # Los mensajes que encolan los demás workers no despiertan al repartidor
+            next_due = next_notification_due()
+            if leader and next_due is not None and next_due <= time.time():
+                wake_delivery()
+            
+            # Si le toca una tienda nueva (un worker ha caído) o alguien pidió
+            # /check_now en otro worker, se verifica ya
+            current = assigned_providers()
+            if set(current) - set(assigned):
+                print(f"🔀 Tiendas asignadas a este worker: {', '.join(provider_name(key) for key in current)}")
+                request_check()
+            assigned = current
+            requested_at = get_state('check_requested_at', 0)
+            if requested_at > _cluster['check_seen_at']:
+                _cluster['check_seen_at'] = requested_at
+                request_check()
+            
+            if _shutdown_event is None:
+                await asyncio.sleep(LEASE_RENEW_INTERVAL)
+                continue
+            try:
+                await asyncio.wait_for(_shutdown_event.wait(), timeout=LEASE_RENEW_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        
+        # Cierre: se deja terminar el envío en curso (lo pendiente sigue en la cola)
+        if leader_tasks:
+            await asyncio.wait(leader_tasks, timeout=shutdown_time_left())
+    finally:
+        for task in leader_tasks:
+            task.cancel()
+        leave_cluster()
 
 # =============================================================================
 # MAIN
 # =============================================================================
 
-async def main():
-    """Función principal del bot"""
+async def run_cycle():
+    """
+    Un ciclo de verificación: consulta todas las tiendas, encola las ofertas
+    nuevas de cada chat y despierta al repartidor. Devuelve cuántos mensajes
+    se encolaron.
+    """
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Verificando ofertas...")
+    cycle_started = time.perf_counter()
+    
+    # Verificar a la vez las tiendas de este worker (retomando un ciclo interrumpido)
+    keys = assigned_providers()
+    checkpoint_key = shard_state_key('cycle', keys)
+    offers = await check_providers_resumable(keys, checkpoint_key)
+    
+    # Un solo scraping para todos los chats: cada uno filtra en memoria.
+    # Solo se avisa de los cambios respecto al ciclo anterior.
+    subscribers = get_subscribers()
+    total_new = 0
+    for key, games in offers.items():
+        new_count = 0
+        try:
+            # Historial y cola en una sola transacción: un corte no deja cambios sin avisar
+            with get_notified_db() as db:
+                db.execute("BEGIN IMMEDIATE")
+                # Otro worker pudo procesar esta tienda desde el último ciclo de
+                # este (aunque ahora esté solo): se relee siempre, ya bloqueada
+                _offer_snapshots.pop(key, None)
+                changes = diff_offers(key, games, complete=key not in _incomplete_providers)
+                for change, game in changes:
+                    if change not in NOTIFY_CHANGES:
+                        continue
+                    game = {**game, 'change': change}
+                    for subscriber in subscribers:
+                        chat_id = str(subscriber['chat_id'])
+                        if not matches_subscriber(subscriber, key, game):
+                            continue
+                        # Una oferta ya avisada a este chat dentro de NOTIFIED_RETENTION_DAYS no
+                        # se repite aunque la tienda la haya quitado y vuelto a poner
+                        if change == 'new' and is_notified(chat_id, key, game['id']):
+                            continue
+                        if enqueue_notification(chat_id, key, game):
+                            new_count += 1
+                
+                # Los chats añadidos después (también en caliente) reciben las
+                # promociones que ya estaban abiertas y aún no se les avisaron
+                if 'new' in NOTIFY_CHANGES:
+                    new_ids = {str(game['id']) for change, game in changes if change == 'new'}
+                    notified = set(db.execute(
+                        "SELECT chat_id, game_id FROM notified_games WHERE platform = ?", (key,)
+                    ).fetchall())
+                    for game in games:
+                        if str(game['id']) in new_ids:
+                            continue
+                        for subscriber in subscribers:
+                            chat_id = str(subscriber['chat_id'])
+                            if ((chat_id, str(game['id'])) in notified
+                                    or not matches_subscriber(subscriber, key, game)):
+                                continue
+                            if enqueue_notification(chat_id, key, {**game, 'change': 'new'}):
+                                new_count += 1
+        except BaseException:
+            # Transacción deshecha: la foto en memoria se vuelve a leer de la base
+            _offer_snapshots.pop(key, None)
+            raise
+        
+        total_new += new_count
+        if new_count > 0:
+            print(f"   ✓ {new_count} mensaje(s) de {provider_name(key)} en cola de envío")
+    
+    # Todas las ofertas del ciclo están en cola: se envían juntas
+    wake_delivery()
+    
+    if not any(offers.values()):
+        print("   ℹ️  No se encontraron nuevas ofertas")
+    
+    # Limpiar juegos antiguos y portadas caducadas después de cada verificación
+    clean_old_games()
+    prune_image_cache()
+    
+    # Ciclo completo: ya no hay nada que retomar
+    set_state(checkpoint_key, None)
+    
+    set_gauge('freegames_cycle_duration_seconds', time.perf_counter() - cycle_started)
+    set_gauge('freegames_last_cycle_timestamp_seconds', time.time())
+    rss = peak_rss_mb()
+    if rss is not None:
+        set_gauge('freegames_peak_rss_bytes', int(rss * 1024 * 1024))
+    _status.update(last_cycle_at=time.time(), last_cycle_new=total_new)
+    return total_new
+
+async def run_once():
+    """
+    Modo --once (cron, temporizador de systemd): un ciclo, envío de lo que
+    toca de la cola y salida. Sin mensajes que enviar no se carga Telegram.
+    """
+    try:
+        await finish_or_cancel(asyncio.create_task(run_cycle()))
+        next_due = next_notification_due()
+        if not shutdown_flag and next_due is not None and next_due <= time.time():
+            await finish_or_cancel(asyncio.create_task(deliver_pending(get_bot())))
+    except asyncio.CancelledError:
+        # Cierre pedido (p. ej. al parar el temporizador): el punto de control
+        # y la cola conservan lo hecho para la próxima ejecución
+        print("\n⚠️  Ciclo cancelado, se retomará en la próxima ejecución")
+    pending = count_pending_notifications()
+    if pending:
+        print(f"📬 {pending} mensaje(s) quedan en cola para la próxima ejecución")
+
+async def main(once=False, verify=False):
+    """
+    Función principal del bot
+    once: un solo ciclo y salir (ver run_once)
+    verify: repetir la prueba de Telegram aunque ya se hiciera
+    """
     
-    # Configurar manejador de señales para cierre limpio
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    # Señales atendidas por el bucle de eventos para un cierre limpio
+    install_signal_handlers()
+    
+    # Entorno y archivo de configuración por encima de los valores del script
+    load_config()
     
     # Validar configuración
     if TELEGRAM_BOT_TOKEN == "TU_TOKEN_DE_BOT":
         print("❌ ERROR: Configura tu TELEGRAM_BOT_TOKEN")
         return
     
-    if TELEGRAM_CHAT_ID == "TU_CHAT_ID":
+    if TELEGRAM_CHAT_ID == "TU_CHAT_ID" and not SUBSCRIBERS:
         print("❌ ERROR: Configura tu TELEGRAM_CHAT_ID")
         return
     
     print("=" * 60)
     print("🤖 BOT DE JUEGOS GRATIS - Iniciando...")
     print("=" * 60)
+    report_footprint("Arranque")
     
-    # Inicializar bot
-    try:
-        bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    except Exception as e:
-        print(f"❌ Error al crear el bot: {e}")
-        return
-    
-    # Probar conexión con Telegram
-    if not await test_telegram_connection(bot):
+    # Probar conexión con Telegram (solo si el token o los chats han cambiado)
+    if not await verify_telegram(force=verify):
         print("\n⚠️  No se pudo establecer conexión con Telegram.")
         print("⚠️  Verifica tu configuración y vuelve a intentar.\n")
+        close_notified_db()
         return
     
-    print(f"\n⏱️  Intervalo de verificación: {CHECK_INTERVAL} segundos")
-    print(f"📁 Archivo de registro: {NOTIFIED_GAMES_FILE}\n")
+    if once:
+        try:
+            await run_once()
+        finally:
+            await close_http_client()
+            close_notified_db()
+        report_footprint("Fin")
+        return
     
-    # Cargar juegos ya notificados
-    notified_games = load_notified_games()
+    print(f"\n⏱️  Intervalo de verificación: {CHECK_INTERVAL} segundos")
+    print(f"📁 Archivo de registro: {NOTIFIED_DB_FILE}\n")
     
-    # Limpiar juegos antiguos (más de 7 días)
-    notified_games = clean_old_games(notified_games, days=7)
-    save_notified_games(notified_games)
+    # La limpieza de juegos antiguos se hace al final de cada ciclo
+    registered = ", ".join(f"{provider_name(key)}={count}" for key, count in count_notified().items())
+    print(f"📊 Juegos registrados: {registered}\n")
     
-    print(f"📊 Juegos registrados: Steam={len(notified_games['steam'])}, Epic={len(notified_games['epic'])}\n")
+    # Entrada en el grupo de workers: el líder ejecuta el repartidor de la cola
+    # (que también envía lo que quedó pendiente) y los comandos
+    renew_membership()
+    if len(_cluster['workers']) > 1:
+        print(f"👥 Worker {WORKER_ID} ({len(_cluster['workers'])} en marcha), consulta: "
+              f"{', '.join(provider_name(key) for key in assigned_providers()) or 'ninguna tienda'}")
+    cluster_task = asyncio.create_task(cluster_worker())
+    background_tasks = [cluster_task, asyncio.create_task(config_watcher())]
+    if TELEGRAM_COMMANDS:
+        print("💬 Comandos disponibles: /status, /check_now, /interval, /stats, /history")
+    metrics_server = await start_metrics_server()
     print("💡 Presiona Ctrl+C para detener el bot de forma segura\n")
     
+    # Tras un reinicio rápido se respeta la verificación que ya estaba programada
+    # (salvo que haya un ciclo a medias, que se retoma enseguida)
+    resume_at = get_state(shard_state_key('next_check_at'))
+    if resume_at and resume_at > time.time() and get_state(shard_state_key('cycle')) is None:
+        delay = int(resume_at - time.time())
+        _status.update(next_check_at=resume_at, next_check_reason="programada antes del reinicio")
+        print(f"⏳ Próxima verificación en {delay} segundos (programada antes del reinicio)...\n")
+        await wait_next_check(time.time(), delay)
+    
+    loop_failures = 0
     while not shutdown_flag:
         try:
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Verificando ofertas...")
-            
-            # Verificar Steam
-            print("🔍 Verificando Steam...")
-            steam_games = check_steam_via_steamdb()
-            
-            new_steam = 0
-            for game in steam_games:
-                if game['id'] not in notified_games['steam']:
-                    if await send_telegram_message(bot, game):
-                        notified_games['steam'][game['id']] = time.time()
-                        save_notified_games(notified_games)
-                        new_steam += 1
-            
-            if new_steam > 0:
-                print(f"   ✓ {new_steam} nuevo(s) juego(s) de Steam notificado(s)")
-            
-            # Verificar Epic Games
-            print("🔍 Verificando Epic Games...")
-            epic_games = check_epic_free_games()
-            
-            new_epic = 0
-            for game in epic_games:
-                if game['id'] not in notified_games['epic']:
-                    if await send_telegram_message(bot, game):
-                        notified_games['epic'][game['id']] = time.time()
-                        save_notified_games(notified_games)
-                        new_epic += 1
-            
-            if new_epic > 0:
-                print(f"   ✓ {new_epic} nuevo(s) juego(s) de Epic Games notificado(s)")
-            
-            if not steam_games and not epic_games:
-                print("   ℹ️  No se encontraron nuevas ofertas")
-            
-            # Limpiar juegos antiguos después de cada verificación
-            notified_games = clean_old_games(notified_games, days=7)
-            save_notified_games(notified_games)
+            total_new = await finish_or_cancel(asyncio.create_task(run_cycle()))
+            loop_failures = 0
             
             # Esperar hasta la próxima verificación
-            print(f"⏳ Próxima verificación en {CHECK_INTERVAL} segundos...\n")
+            last_check = time.time()
+            delay, reason = next_check_delay(total_new > 0)
+            _status.update(next_check_at=last_check + delay, next_check_reason=reason)
+            set_state(shard_state_key('next_check_at'), last_check + delay)
+            print(f"⏳ Próxima verificación en {delay} segundos ({reason})...\n")
             
-            # Usar sleep con verificación de shutdown
-            try:
-                for i in range(CHECK_INTERVAL):
-                    if shutdown_flag:
-                        break
-                    await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                print("\n⚠️  Operación cancelada, cerrando...")
-                break
+            # Espera interrumpible (cierre, /check_now, /interval o recarga de config)
+            await wait_next_check(last_check, delay)
             
-        except KeyboardInterrupt:
-            print("\n⚠️  Bot detenido por el usuario")
-            break
         except asyncio.CancelledError:
-            print("\n⚠️  Bot detenido")
+            print("\n⚠️  Ciclo cancelado")
             break
         except Exception as e:
-            print(f"❌ Error en el bucle principal: {e}")
-            try:
-                await asyncio.sleep(60)
-            except (asyncio.CancelledError, KeyboardInterrupt):
-                print("\n⚠️  Bot detenido durante recuperación de error")
-                break
+            loop_failures += 1
+            delay = backoff_delay(loop_failures, ERROR_BACKOFF_BASE, ERROR_BACKOFF_MAX)
+            print(f"❌ Error en el bucle principal: {e} (reintento en {int(delay)}s)")
+            await wait_next_check(time.time(), delay)
+    
+    # El worker deja terminar el envío en curso (lo pendiente sigue en la cola)
+    # y suelta el lease; el resto de tareas se cancela
+    await asyncio.wait({cluster_task}, timeout=shutdown_time_left() + 1)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if metrics_server is not None:
+        metrics_server.close()
+    await close_http_client()
+    close_notified_db()
+    print("✅ Bot detenido correctamente")
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bot de Telegram que avisa de juegos gratis en Steam y Epic")
+    parser.add_argument('--once', action='store_true',
+                        help="Ejecuta un solo ciclo y termina (para cron o un temporizador de systemd)")
+    parser.add_argument('--verify', action='store_true',
+                        help="Repite la prueba del token y el mensaje de prueba aunque ya se hicieran")
+    return parser.parse_args()
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(once=args.once, verify=args.verify))
     except KeyboardInterrupt:
         print("\n⚠️  Bot detenido correctamente")
     except Exception as e: